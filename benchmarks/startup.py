@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# Track the start-up cost of the command line on a stow which has nothing
+# to do, as when nzmstow runs from shell hooks and login scripts.
+#
+#   python benchmarks/startup.py [--repeat N] [--output FILE]
+#                                [--compare FILE] [--tolerance F]
+#
+# The import time is the sum of what python -X importtime reports for the
+# run, and the wall time is that of the whole process less the start-up of
+# the interpreter itself. Modules which only some options need must not be
+# imported. The exit status is 1 if one is, or if a time is more than
+# tolerance times the one in the --compare results.
+
+import os
+import os.path
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+from statistics import median
+from time import perf_counter
+
+RESULTS_VERSION = 1
+
+# imported only by the options which use them, or by a scan big enough to
+# use threads. tests/test_startup.py checks the same modules
+LAZY = ('nzmstow.watcher', 'nzmstow.journal', 'nzmstow.ignore.cache',
+        'nzmstow.manifest', 'nzmstow.plan', 'nzmstow.clone', 'json', 'ctypes', 'fcntl',
+        'tempfile', 'hashlib', 'concurrent.futures')
+
+def package(root):
+    # a small package which is already stowed
+    source = os.path.join(root, 'pkg')
+    target = os.path.join(root, 'target')
+    for d in ('.config/app', '.local/bin'):
+        os.makedirs(os.path.join(source, d))
+    for f in ('.profile', '.config/app/config', '.local/bin/tool'):
+        with open(os.path.join(source, f), 'w') as file:
+            file.write(f + '\n')
+    os.mkdir(target)
+    return source, target
+
+def run(args):
+    t = perf_counter()
+    p = subprocess.run(args, capture_output=True, text=True, check=True)
+    return perf_counter() - t, p.stderr
+
+def importtime(stderr):
+    # seconds spent importing and the modules imported
+    total = 0
+    M = set()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        total += int(self_us)
+        M.add(name.strip())
+    return total / 1e6, M
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--output', help='write results to this file instead of stdout')
+    parser.add_argument('--compare', help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='how many times slower than --compare counts as a regression')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='nzmstow-startup-')
+    try:
+        source, target = package(root)
+        cli = [sys.executable, '-m', 'nzmstow', '-t', target, source]
+        run(cli)
+        base, imports, wall = [], [], []
+        M = set()
+        for _ in range(args.repeat):
+            base.append(run([sys.executable, '-c', 'pass'])[0])
+            t, _ = run(cli)
+            wall.append(t)
+            _, stderr = run([sys.executable, '-X', 'importtime', *cli[1:]])
+            t, M = importtime(stderr)
+            imports.append(t)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    b = min(base)
+    R = {
+        'import': { 'min': min(imports), 'median': median(imports) },
+        'wall': { 'min': min(wall) - b, 'median': median(wall) - b },
+        'interpreter': b,
+    }
+    eager = sorted( m for m in LAZY if m in M )
+
+    old = {}
+    if args.compare:
+        with open(args.compare) as file:
+            old = json.load(file)['results']
+    failed = bool(eager)
+    for k in ('import', 'wall'):
+        line = f'{k:>8} {R[k]["min"] * 1000:9.2f}ms {R[k]["median"] * 1000:9.2f}ms'
+        if (o := old.get(k)):
+            x = R[k]['min'] / o['min']
+            line += f' {x:6.2f}x'
+            failed |= x > args.tolerance
+        print(line, file=sys.stderr)
+    for m in eager:
+        print(f'imported without being needed: {m}', file=sys.stderr)
+
+    out = { 'version': RESULTS_VERSION, 'python': sys.version, 'repeat': args.repeat,
+            'results': R, 'eager': eager }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(out, file, indent=1)
+    else:
+        json.dump(out, sys.stdout, indent=1)
+    return int(failed)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# Time the phases of nzmstow on synthetic trees of several sizes.
+#
+#   python benchmarks/suite.py [--sizes N,N,...] [--repeat N] [--output FILE]
+#                              [--compare FILE] [treegen options]
+#
+# Each size is a number of files per package. The phases are compiling the
+# ignore files, scanning the sources, and stowing, restowing and unstowing
+# them. Results are written as JSON so runs on different commits can be
+# compared with --compare.
+
+import os
+import os.path
+import sys
+import json
+import shutil
+import logging
+import platform
+import argparse
+import tempfile
+import subprocess
+from statistics import median
+from time import perf_counter
+from nzmstow import stow, restow, unstow
+from nzmstow.lib import scan_sources
+from nzmstow.ignore import compile_gitignore
+from treegen import generate, IGNORE_NAME
+
+RESULTS_VERSION = 1
+
+def ignore_files(P):
+    return tuple( os.path.join(d, IGNORE_NAME)
+                  for p in P for d, _, F in os.walk(p) if IGNORE_NAME in F )
+
+def phases(target, P, /, jobs, executor):
+    G = ignore_files(P)
+    def compile_all():
+        for g in G:
+            with open(g) as file:
+                compile_gitignore(file)
+    kw = { 'ignore_name': IGNORE_NAME, 'jobs': jobs, 'executor': executor }
+    # stow, restow and unstow leave the target as it was for the next round
+    return {
+        'ignore-compile': compile_all,
+        'scan': lambda: scan_sources(target, *P, **kw),
+        'stow': lambda: stow(target, *P, **kw),
+        'restow': lambda: restow(target, *P, **kw),
+        'unstow': lambda: unstow(target, *P, **kw),
+    }
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1000,10000',
+                        help='comma separated files per package')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='write results to this file instead of stdout')
+    parser.add_argument('--compare', help='results of an earlier run to compare with')
+    parser.add_argument('--workdir', help='where trees are generated (default: a'
+                                          ' temporary directory)')
+    parser.add_argument('--packages', type=int, default=4)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=4)
+    parser.add_argument('--rules', type=int, default=8, help='rules per ignore file')
+    parser.add_argument('--negations', type=float, default=0.1)
+    parser.add_argument('--globstar', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-j', '--jobs', type=int)
+    parser.add_argument('--executor', default='auto')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    params = { k: getattr(args, k) for k in ('packages', 'depth', 'fanout', 'rules',
+                                             'negations', 'globstar', 'seed',
+                                             'jobs', 'executor', 'repeat') }
+    R = []
+    workdir = tempfile.mkdtemp(prefix='nzmstow-bench-', dir=args.workdir)
+    try:
+        for size in map(int, args.sizes.split(',')):
+            root = os.path.join(workdir, str(size))
+            P = generate(root, packages=args.packages, files=size, depth=args.depth,
+                         fanout=args.fanout, rules_per_file=args.rules,
+                         negations=args.negations, globstar=args.globstar,
+                         seed=args.seed)
+            C = phases(os.path.join(root, 'target'), P, jobs=args.jobs,
+                       executor=args.executor)
+            T = { k: [] for k in C }
+            for _ in range(args.repeat):
+                for k, f in C.items():
+                    t = perf_counter()
+                    f()
+                    T[k].append(perf_counter() - t)
+            for k, times in T.items():
+                R.append({ 'files': size, 'phase': k, 'times': times,
+                           'min': min(times), 'median': median(times) })
+            shutil.rmtree(root)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    old = {}
+    if args.compare:
+        with open(args.compare) as file:
+            old = { (r['files'], r['phase']): r['min'] for r in json.load(file)['results'] }
+    for r in R:
+        line = f'{r["files"]:>8} {r["phase"]:>15} {r["min"]:9.4f}s {r["median"]:9.4f}s'
+        if (o := old.get((r['files'], r['phase']))):
+            line += f' {r["min"] / o:6.2f}x'
+        print(line, file=sys.stderr)
+
+    out = { 'version': RESULTS_VERSION, 'commit': commit(), 'python': sys.version,
+            'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'params': params, 'results': R }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(out, file, indent=1)
+    else:
+        json.dump(out, sys.stdout, indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# Compare computing symbolic link texts per file with computing them once
+# per pair of source and target directories.
+#
+#   python benchmarks/symlink_text.py [--dirs N] [--files N] [--repeat N]
+
+import os
+import os.path
+import argparse
+import timeit
+from nzmstow.lib import symlink_texts
+
+def per_file(sf, tf):
+    return os.path.relpath(os.path.abspath(sf),
+                           os.path.abspath(os.path.dirname(tf)))
+
+def plan(dirs, files):
+    for i in range(dirs):
+        d = os.path.join('pkg', 'share', f'd{i // 16}', f'd{i}')
+        for j in range(files):
+            sf = os.path.join(d, f'f{j}')
+            yield sf, os.path.join('target', 'share', f'd{i // 16}', f'd{i}', f'f{j}')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dirs', type=int, default=1000)
+    parser.add_argument('--files', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    ST = tuple(plan(args.dirs, args.files))
+    assert [ per_file(*st) for st in ST ] == [ symlink_texts()(*st) for st in ST ]
+
+    C = {
+        'per-file': lambda: [ per_file(sf, tf) for sf, tf in ST ],
+        'per-dir': lambda: [ text(sf, tf) for text in (symlink_texts(),) for sf, tf in ST ],
+        'absolute': lambda: [ text(sf, tf) for text in (symlink_texts(True),) for sf, tf in ST ],
+    }
+    print(f'{len(ST)} links in {args.dirs} directories')
+    for k, f in C.items():
+        t = min(timeit.repeat(f, number=1, repeat=args.repeat))
+        print(f'{k:>10}: {t:8.4f}s {len(ST) / t:12.0f} links/s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# Generate reproducible synthetic package trees to stow.
+#
+#   python benchmarks/treegen.py ROOT [--packages N] [--files N] [--depth N]
+#                                     [--fanout N] [--rules N] [--negations F]
+#                                     [--globstar F] [--seed N]
+#
+# ROOT/pkgN are the packages and ROOT/target is an empty target. Every
+# package has the same shape: a directory tree of the given depth and
+# fan-out with its files spread over all directories. Ignore files are
+# written to the package root and to the first directory of each level.
+
+import os
+import os.path
+import random
+import argparse
+
+IGNORE_NAME = '.nzmstow-local-ignore'
+
+EXTENSIONS = ('.txt', '.conf', '.py', '.log', '.o', '.tmp')
+
+# rule shapes; {e} is an extension without its dot, {d} a directory name
+# and {n} a number
+PLAIN = ('*.{e}', '/d{d}/*.{e}', '*f{n}.*', 'd{d}/', '/p*f{n}.{e}', 'p[0-3]f{n}?*')
+GLOBSTAR = ('**/d{d}/', '**/*.{e}', 'd{d}/**/*f{n}*', '**/d{d}/**/*.{e}')
+
+def rules(n, /, negations=0.1, globstar=0.2, rng=random):
+    for _ in range(n):
+        shape = rng.choice(GLOBSTAR if rng.random() < globstar else PLAIN)
+        rule = shape.format(e=rng.choice(EXTENSIONS)[1:], d=rng.randrange(8),
+                            n=rng.randrange(100))
+        yield ( '!' + rule ) if rng.random() < negations else rule
+
+def dirs(depth, fanout):
+    # breadth first, so that the first directory of each level is a
+    # different depth of the first branch
+    L = ['']
+    yield ''
+    for _ in range(depth):
+        L = [ os.path.join(d, f'd{i}') for d in L for i in range(fanout) ]
+        yield from L
+
+def generate(root, /, packages=4, files=1000, depth=3, fanout=4, rules_per_file=8,
+             negations=0.1, globstar=0.2, seed=0):
+    rng = random.Random(seed)
+    D = list(dirs(depth, fanout))
+    # where ignore files go: the package root and one directory per level
+    G = { '' } | { os.path.join(*( ['d0'] * k )) for k in range(1, depth + 1) }
+    os.makedirs(os.path.join(root, 'target'), exist_ok=True)
+    for p in range(packages):
+        pkg = os.path.join(root, f'pkg{p}')
+        for d in D:
+            os.makedirs(os.path.join(pkg, d), exist_ok=True)
+        for n in range(files):
+            d = D[n % len(D)]
+            name = f'f{n}{rng.choice(EXTENSIONS)}'
+            # packages must not overlap in the target
+            with open(os.path.join(pkg, d, f'p{p}{name}'), 'w') as file:
+                file.write(name)
+        for d in G:
+            if rules_per_file:
+                with open(os.path.join(pkg, d, IGNORE_NAME), 'w') as file:
+                    file.writelines( r + '\n' for r in rules(rules_per_file,
+                                                             negations=negations,
+                                                             globstar=globstar, rng=rng) )
+    return tuple( os.path.join(root, f'pkg{p}') for p in range(packages) )
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('root')
+    parser.add_argument('--packages', type=int, default=4)
+    parser.add_argument('--files', type=int, default=1000, help='files per package')
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=4)
+    parser.add_argument('--rules', type=int, default=8, help='rules per ignore file')
+    parser.add_argument('--negations', type=float, default=0.1,
+                        help='fraction of negated rules')
+    parser.add_argument('--globstar', type=float, default=0.2,
+                        help='fraction of rules with **')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    generate(args.root, packages=args.packages, files=args.files, depth=args.depth,
+             fanout=args.fanout, rules_per_file=args.rules, negations=args.negations,
+             globstar=args.globstar, seed=args.seed)
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,22 @@
 __all__ = []
 
-from .lib import stow, unstow, StowError
-from .entry import main as _main
+# names are imported from their modules on first use, so that the command
+# line loads only what its options need
+
+_EXPORTS = {
+    'stow': 'lib', 'unstow': 'lib', 'restow': 'lib', 'status': 'lib',
+    'apply_plan': 'lib', 'resume': 'lib', 'StowError': 'lib',
+    'watch': 'watcher',
+    'profile': 'stats',
+}
+
+def __getattr__(name):
+    if (m := _EXPORTS.get(name)) is None:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    from importlib import import_module
+    v = globals()[name] = getattr(import_module(f'.{m}', __name__), name)
+    return v
+
+def _main():
+    from .entry import main
+    return main()
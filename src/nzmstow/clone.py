@@ -0,0 +1,116 @@
+import os
+import os.path
+import stat
+import errno
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from .stats import count
+
+# from <linux/fs.h>: share the extents of one file with another
+FICLONE = 0x40049409
+
+# bytes asked for by one copy_file_range, sendfile or read
+CHUNK_SIZE = 1 << 30
+READ_SIZE = 1 << 20
+
+# errors which mean that a way of copying is not supported between two
+# files, as opposed to the copy failing
+UNSUPPORTED = { errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTTY, errno.EXDEV, errno.EINVAL,
+                errno.ENOSYS }
+
+# ways found unsupported between a source and a target device, which
+# are not tried again
+_unsupported = {}
+
+def copy_file(sf, tf, dir_fd=None):
+    # copies sf to a new file tf and gives it the mode and times of sf, by
+    # which it is recognised as a copy later. the data is cloned if the
+    # file system can share it, else copied in the kernel, and read and
+    # written only if neither works. returns the way it was copied
+    sfd = os.open(sf, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        st = os.fstat(sfd)
+        dfd = os.open(tf, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0),
+                      stat.S_IMODE(st.st_mode), dir_fd=dir_fd)
+        try:
+            how = _copy_data(sfd, dfd, (st.st_dev, os.fstat(dfd).st_dev))
+            if hasattr(os, 'fchmod'):
+                os.fchmod(dfd, stat.S_IMODE(st.st_mode))
+            if os.utime in os.supports_fd:
+                os.utime(dfd, ns=(st.st_atime_ns, st.st_mtime_ns))
+        except BaseException:
+            os.close(dfd)
+            dfd = None
+            # a partial copy would look foreign to the next run
+            try:
+                os.unlink(tf, dir_fd=dir_fd)
+            except OSError:
+                pass
+            raise
+        finally:
+            if dfd is not None:
+                os.close(dfd)
+        if not os.utime in os.supports_fd:
+            os.utime(tf, ns=(st.st_atime_ns, st.st_mtime_ns), dir_fd=dir_fd)
+    finally:
+        os.close(sfd)
+    count(f'copy-{how}')
+    return how
+
+def _copy_data(sfd, dfd, devs):
+    U = _unsupported.setdefault(devs, set())
+    if fcntl is not None and 'clone' not in U:
+        try:
+            fcntl.ioctl(dfd, FICLONE, sfd)
+            return 'clone'
+        except OSError as e:
+            if e.errno not in UNSUPPORTED:
+                raise
+            U.add('clone')
+    for how, f in (('copy_file_range', _copy_file_range), ('sendfile', _sendfile)):
+        if how in U or not hasattr(os, how):
+            continue
+        try:
+            f(sfd, dfd)
+            return how
+        except _Unsupported:
+            U.add(how)
+    while (b := os.read(sfd, READ_SIZE)):
+        while b:
+            b = b[os.write(dfd, b):]
+    return 'read'
+
+class _Unsupported(Exception):
+    pass
+
+def _copy_file_range(sfd, dfd):
+    first = True
+    try:
+        while os.copy_file_range(sfd, dfd, CHUNK_SIZE):
+            first = False
+    except OSError as e:
+        # only the first call can fail without having copied anything
+        if first and e.errno in UNSUPPORTED:
+            raise _Unsupported from e
+        raise
+
+def _sendfile(sfd, dfd):
+    first = True
+    try:
+        while os.sendfile(dfd, sfd, None, CHUNK_SIZE):
+            first = False
+    except OSError as e:
+        if first and e.errno in UNSUPPORTED:
+            raise _Unsupported from e
+        raise
+
+def same_copy(size, mtime_ns, tst):
+    # whether a file with stat result tst is a copy of one with size and
+    # mtime_ns. times on file systems with whole seconds are compared in
+    # whole seconds
+    if not stat.S_ISREG(tst.st_mode) or tst.st_size != size:
+        return False
+    b = tst.st_mtime_ns
+    return b == mtime_ns or b % 10**9 == 0 and b // 10**9 == mtime_ns // 10**9
@@ -1,18 +1,29 @@
 import os
 import os.path
+import sys
 import logging
 import argparse
-from . import stow, unstow, StowError
+from contextlib import nullcontext
+
+# the library is imported by run() and the rest where it is used, as
+# start-up time counts when nzmstow runs from shell hooks
 
 def main():
+    from .executor import EXECUTORS
     parser = argparse.ArgumentParser(prog='nzmstow', add_help=False,
-                                     usage='%(prog)s [OPTION]... [-t TARGET] SOURCE...')
+                                     usage='%(prog)s [OPTION]... [-t TARGET]... SOURCE...')
 
     parser.add_argument('-t', help='path to directory where stowing into or deleting from'
-                                   ' SOURCE (default: current working directory)',
-                        default=os.curdir, metavar='TARGET')
+                                   ' SOURCE (default: current working directory); may'
+                                   ' be given several times, scanning SOURCE once for'
+                                   ' all of them',
+                        action='append', metavar='TARGET')
     parser.add_argument('-D', help='delete source files from TARGET',
                         action='store_true')
+    parser.add_argument('-R', help='restow SOURCE, i.e. only create missing links and'
+                                   ' delete links into SOURCE which are not planned'
+                                   ' anymore',
+                        action='store_true')
     parser.add_argument('-f', help='delete target files even if target file and'
                                    ' source file are not the same file when'
                                    ' unstowing (with -D), or delete target files'
@@ -24,17 +35,100 @@ def main():
                         action='store_true')
     parser.add_argument('-l', help='create hard links instead of symbolic links',
                         action='store_true')
-#    parser.add_argument('--no-parallel', help='force to not take actioins for SOURCEs'
-#                                              ' in parallel', 
-#                        action='store_false')
+    parser.add_argument('--copy', help='create copies of files instead of links, which'
+                                       ' are left alone while their size and mtime'
+                                       ' match SOURCE (not with -l or --scan-target)',
+                        action='store_true')
+    parser.add_argument('--absolute', help='create symbolic links with absolute paths'
+                                           ' to SOURCE instead of relative ones',
+                        action='store_true')
+    parser.add_argument('--fold', help='create one symbolic link for a directory which'
+                                       ' does not exist in TARGET and is provided by'
+                                       ' only one SOURCE, and unfold such links when'
+                                       ' another SOURCE needs the directory',
+                        action='store_true')
+    parser.add_argument('--stream', help='create directories and links while SOURCE is'
+                                         ' still being scanned, keeping memory bounded'
+                                         ' (not with --fold or --manifest)',
+                        action='store_true')
+    parser.add_argument('--manifest', help='record created directories and links in'
+                                           ' TARGET/.nzmstow-manifest, and delete what is'
+                                           ' recorded there instead of scanning SOURCE'
+                                           ' (with -D)',
+                        action='store_true')
+    parser.add_argument('--scan-target', help='find links into SOURCE by scanning TARGET'
+                                              ' instead of SOURCE, so that a moved or'
+                                              ' partly deleted SOURCE can be deleted'
+                                              ' (with -D)',
+                        action='store_true')
+    parser.add_argument('--ignore-cache', help='keep translated ignore files in'
+                                               ' $XDG_CACHE_HOME/nzmstow and reuse them'
+                                               ' while they are unchanged',
+                        action='store_true')
+    parser.add_argument('--plan', help='write what would be done to FILE (- for stdout)'
+                                       ' instead of doing it; the manifest is not'
+                                       ' changed',
+                        metavar='FILE')
+    parser.add_argument('--apply-plan', help='do what is written in FILE (- for stdin),'
+                                             ' without SOURCE or TARGET',
+                        metavar='FILE')
+    parser.add_argument('--journal', help='record in FILE which operations are done, so'
+                                          ' that an interrupted run can be continued'
+                                          ' with --resume',
+                        metavar='FILE')
+    parser.add_argument('--resume', help='continue the run recorded in the --journal FILE'
+                                         ' where it stopped, without SOURCE or TARGET',
+                        action='store_true')
+    parser.add_argument('--watch', help='stow SOURCE and keep TARGET in sync with it until'
+                                        ' interrupted, linking and deleting only what'
+                                        ' changed (not with -D, -R, -l, --copy,'
+                                        ' --fold, --manifest or --plan)',
+                        action='store_true')
+    parser.add_argument('--poll', help='with --watch, look for changes every SECONDS'
+                                       ' instead of using inotify',
+                        type=float, metavar='SECONDS')
+    parser.add_argument('--status', help='show recorded links of SOURCE that are missing'
+                                         ' or changed in TARGET',
+                        action='store_true')
+    parser.add_argument('-j', '--jobs', help='number of parallel workers (default: number'
+                                             ' of CPUs, 1 takes actions serially)',
+                        type=int, metavar='N')
+    parser.add_argument('--executor', help='how to run actions in parallel (default: auto,'
+                                           ' i.e. serially for small plans and in threads'
+                                           ' otherwise)',
+                        choices=EXECUTORS, default='auto')
+    parser.add_argument('--profile', help='write the time of each phase, counts of file'
+                                          ' system calls and worker utilisation as JSON'
+                                          ' to stderr at the end',
+                        action='store_true')
+    parser.add_argument('--profile-output', help='write the --profile report to FILE'
+                                                 ' instead',
+                        metavar='FILE')
     parser.add_argument('-q', help='decrease output verbosity (qq is quieter)',
                         action='count', default=0)
     parser.add_argument('-v', help='increase output verbosity (vv is more verbose)',
                         action='count', default=0)
     parser.add_argument('-h', '--help', help='show this help message and exit', action='help')
-    parser.add_argument('source', help='path(s) to directory to be stowed', nargs='+',
+    parser.add_argument('source', help='path(s) to directory to be stowed', nargs='*',
                         metavar='SOURCE')
     args = parser.parse_args()
+    if args.resume and args.journal is None:
+        parser.error('--resume needs --journal FILE')
+    if not args.source and args.apply_plan is None and not args.resume:
+        parser.error('the following arguments are required: SOURCE')
+    if args.watch and (args.D or args.R or args.l or args.copy or args.fold or args.manifest
+                       or args.plan is not None):
+        parser.error('--watch cannot be used with -D, -R, -l, --copy, --fold, --manifest'
+                     ' or --plan')
+    if args.copy and (args.l or args.scan_target):
+        parser.error('--copy cannot be used with -l or --scan-target')
+    if args.t and len(args.t) > 1 and (args.watch or args.stream or args.plan is not None
+                                       or args.journal is not None):
+        parser.error('--watch, --stream, --plan and --journal take only one TARGET')
+    if args.watch and args.journal is not None:
+        parser.error('--watch cannot be used with --journal')
+    if args.profile_output is not None and not args.profile:
+        parser.error('--profile-output needs --profile')
 
     level = args.v - args.q
     if level < -1:
@@ -49,36 +143,133 @@ def main():
         level = logging.DEBUG
     logging.basicConfig(level=level)
 
-    t = args.t
-    if not os.path.isdir(t):
-        print(f'Target directory \'{t}\' does not exist.')
+    if not args.profile:
+        return run(args)
+    import json
+    from .stats import profile
+    with profile() as S:
+        r = run(args)
+    try:
+        with ( nullcontext(sys.stderr) if args.profile_output is None else
+               open(args.profile_output, 'w') ) as file:
+            json.dump(S.report(), file, indent=1)
+            file.write('\n')
+    except OSError as e:
+        print(e)
         return 1
+    return r
+
+def run(args):
+    from .lib import stow, unstow, restow, status, apply_plan, resume, StowError
+    if args.resume:
+        try:
+            resume(args.journal, dry_run=args.n, jobs=args.jobs, executor=args.executor)
+        except StowError as e:
+            return 2
+        return
+
+    if args.apply_plan is not None:
+        try:
+            with ( nullcontext(sys.stdin) if args.apply_plan == '-' else
+                   open(args.apply_plan) ) as file:
+                apply_plan(file, dry_run=args.n, jobs=args.jobs, executor=args.executor,
+                           journal=args.journal)
+        except OSError as e:
+            print(e)
+            return 1
+        except StowError as e:
+            return 2
+        return
+
+    T = args.t or [os.curdir]
+    for t in T:
+        if not os.path.isdir(t):
+            print(f'Target directory \'{t}\' does not exist.')
+            return 1
 
-    tdrv = os.path.splitdrive(t)[0]
     S = args.source
     for s in S:
         if not os.path.isdir(s):
+            # recorded packages do not need their source
+            if args.status or args.D and ( args.manifest or args.scan_target ):
+                continue
             print(f'Source directory \'{s}\' does not exist.')
             return 1
 
-        if args.l and os.stat(s).st_dev != os.stat(t).st_dev:
-            print(f'Target directory \'{t}\' and source directory'
-                  f' \'{s}\' must be on the same device for hardlink.')
-            return 1
+        for t in T:
+            if args.l and os.stat(s).st_dev != os.stat(t).st_dev:
+                print(f'Target directory \'{t}\' and source directory'
+                      f' \'{s}\' must be on the same device for hardlink.')
+                return 1
 
-        sdrv = os.path.splitdrive(s)[0]
-        if tdrv != sdrv and (not os.path.isabs(s) or not os.path.isabs(t)):
-            print(f'You have to specify target/source directory \'{s}\''
-                  f' with absolute path if target directory and source directory'
-                  f' have a different drive letter.')
-            return 1
+            tdrv = os.path.splitdrive(t)[0]
+            sdrv = os.path.splitdrive(s)[0]
+            if tdrv != sdrv and (not os.path.isabs(s) or not os.path.isabs(t)):
+                print(f'You have to specify target/source directory \'{s}\''
+                      f' with absolute path if target directory and source directory'
+                      f' have a different drive letter.')
+                return 1
 
-    if args.D:
-        f = lambda t, *S: unstow(t, *S, dry_run=args.n, force_remove=args.f)
+    if args.status:
+        try:
+            R = tuple( r for t in T for r in status(t, *S) if r[2] != 'ok' )
+        except StowError as e:
+            return 2
+        for s, tf, st in R:
+            print(f'{st}:{tf or s}')
+        return int(bool(R))
+
+    # the cache and --watch are imported only when they are asked for
+    cache = None
+    if args.ignore_cache:
+        from .ignore import IgnoreCache
+        cache = IgnoreCache()
+    if args.R:
+        f = lambda t, *S, plan: restow(t, *S, dry_run=args.n, force_remove=args.f,
+                                       create_hardlink=args.l, create_copy=args.copy,
+                                       manifest=args.manifest,
+                                       fold=args.fold, jobs=args.jobs,
+                                       executor=args.executor, absolute=args.absolute,
+                                       plan=plan, ignore_cache=cache, journal=args.journal)
+    elif args.D:
+        f = lambda t, *S, plan: unstow(t, *S, dry_run=args.n, force_remove=args.f,
+                                       create_hardlink=args.l, create_copy=args.copy,
+                                       manifest=args.manifest,
+                                       jobs=args.jobs, executor=args.executor,
+                                       scan_target=args.scan_target, plan=plan,
+                                       ignore_cache=cache, journal=args.journal)
+    elif args.watch:
+        from .watcher import watch, POLL_SECONDS
+        f = lambda t, *S, plan: watch(t, *S, dry_run=args.n, force_remove=args.f,
+                                      jobs=args.jobs, executor=args.executor,
+                                      absolute=args.absolute, ignore_cache=cache,
+                                      poll=args.poll is not None,
+                                      interval=args.poll or POLL_SECONDS)
     else:
-        f = lambda t, *S: stow(t, *S, dry_run=args.n, force_remove=args.f,
-                               create_hardlink=args.l)
+        f = lambda t, *S, plan: stow(t, *S, dry_run=args.n, force_remove=args.f,
+                                     create_hardlink=args.l, create_copy=args.copy,
+                                     manifest=args.manifest,
+                                     fold=args.fold, jobs=args.jobs, executor=args.executor,
+                                     stream=args.stream, absolute=args.absolute,
+                                     plan=plan, ignore_cache=cache, journal=args.journal)
     try:
-        f(t, *S)
+        with ( nullcontext() if args.plan is None else
+               nullcontext(sys.stdout) if args.plan == '-' else
+               open(args.plan, 'w') ) as plan:
+            f(T[0] if len(T) == 1 else tuple(T), *S, plan=plan)
+    except OSError as e:
+        print(e)
+        return 1
     except StowError as e:
         return 2
+    except KeyboardInterrupt:
+        # the way to stop watching
+        if not args.watch:
+            raise
+    finally:
+        if cache is not None:
+            try:
+                cache.save()
+            except OSError as e:
+                # the cache is only an optimisation
+                logging.getLogger(__name__).warning('ignore-cache:%s', e)
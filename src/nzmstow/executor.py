@@ -0,0 +1,127 @@
+import os
+import os.path
+from contextlib import nullcontext
+from itertools import groupby
+from time import perf_counter
+from .stats import profiled
+
+EXECUTORS = ('auto', 'serial', 'thread', 'process')
+
+# 'auto' runs plans smaller than this in the calling thread
+SERIAL_THRESHOLD = 512
+
+# operations per submitted chunk; directories are never split
+CHUNK_SIZE = 256
+
+# seconds of work 'auto' runs in the calling thread before it opens a pool
+# for a run whose size is not known beforehand
+SPILL_SECONDS = .02
+
+# concurrent.futures is only imported once a pool is opened
+
+class Executor:
+    def shutdown(self, wait=True, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        return False
+
+class Done:
+    # the future of a task which has already run
+    __slots__ = ('_result', '_exception')
+
+    def __init__(self, fn, args, kwargs):
+        self._result = self._exception = None
+        try:
+            self._result = fn(*args, **kwargs)
+        except BaseException as e:
+            self._exception = e
+
+    def result(self, timeout=None):
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        return self._exception
+
+    def done(self):
+        return True
+
+    def cancelled(self):
+        return False
+
+    def add_done_callback(self, fn):
+        fn(self)
+
+class SerialExecutor(Executor):
+    def submit(self, fn, /, *args, **kwargs):
+        return Done(fn, args, kwargs)
+
+class SpillExecutor(Executor):
+    # runs tasks in the calling thread until they have taken SPILL_SECONDS,
+    # and the rest in a pool of jobs threads, so that small runs never
+    # start one
+    def __init__(self, jobs, seconds=SPILL_SECONDS):
+        self._jobs = jobs
+        self._left = seconds
+        self._pool = None
+
+    def submit(self, fn, /, *args, **kwargs):
+        if self._pool is None and self._left > 0:
+            t = perf_counter()
+            f = Done(fn, args, kwargs)
+            self._left -= perf_counter() - t
+            return f
+        if self._pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._pool = ThreadPoolExecutor(self._jobs)
+        return self._pool.submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait=True, **kwargs):
+        if self._pool is not None:
+            self._pool.shutdown(wait, **kwargs)
+
+def as_completed(fs):
+    # futures of tasks which have run in the calling thread come first
+    P = [ f for f in fs if not isinstance(f, Done) ]
+    yield from ( f for f in fs if isinstance(f, Done) )
+    if P:
+        import concurrent.futures as cf
+        yield from cf.as_completed(P)
+
+def open_executor(executor='auto', /, jobs=None, size=0):
+    # executor instances given by the caller are used as they are and
+    # are not shut down. with size None, 'auto' starts in the calling
+    # thread and spills into threads
+    if not isinstance(executor, str):
+        return nullcontext(executor)
+    jobs = jobs or os.cpu_count() or 1
+    if executor == 'auto':
+        executor = ( 'serial' if jobs == 1 else 'spill' if size is None else
+                     'serial' if size < SERIAL_THRESHOLD else 'thread' )
+    if executor == 'serial':
+        return profiled(SerialExecutor(), executor, 1)
+    if executor == 'spill':
+        return profiled(SpillExecutor(jobs), executor, jobs)
+    if executor == 'thread':
+        from concurrent.futures import ThreadPoolExecutor
+        return profiled(ThreadPoolExecutor(jobs), executor, jobs)
+    if executor == 'process':
+        from concurrent.futures import ProcessPoolExecutor
+        return profiled(ProcessPoolExecutor(jobs), executor, jobs)
+    raise ValueError(f'unknown executor {executor!r}')
+
+def chunked_by_dir(ST, n=CHUNK_SIZE, key=lambda st: os.path.dirname(st[1])):
+    chunk = []
+    for _, G in groupby(ST, key):
+        chunk.extend(G)
+        if len(chunk) >= n:
+            yield tuple(chunk)
+            chunk = []
+    if chunk:
+        yield tuple(chunk)
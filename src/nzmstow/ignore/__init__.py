@@ -1 +1,8 @@
-from .lib import rparse_gitignore
+from .lib import rwalk, rscopes, enter_scopes, compile_gitignore, is_ignored
+
+def __getattr__(name):
+    # the cache is only imported when it is used
+    if name == 'IgnoreCache':
+        from .cache import IgnoreCache
+        return IgnoreCache
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,102 @@
+import os
+import os.path
+import json
+import time
+import tempfile
+from threading import Lock
+from .lib import translate_gitignore
+
+CACHE_VERSION = 1
+CACHE_NAME = f'ignore-v{CACHE_VERSION}.json'
+
+# entries kept; the least recently used ones are dropped first
+CACHE_MAX_ENTRIES = 4096
+
+# how stale the last use of an entry may get before it is written again
+USED_SECONDS = 3600
+
+# files modified this recently are not cached, as a change within the
+# same mtime tick which keeps the size would not be noticed
+RACY_SECONDS = 2
+
+# {"version": 1,
+#  "entries": {"/abs/ignore/file": {"stat": [st_mtime_ns, st_size, st_ino],
+#                                   "used": time,
+#                                   "rules": [[regex, negate], ...]}}}
+
+def cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'nzmstow')
+
+class IgnoreCache:
+    # translated rules of ignore files, kept between runs. an entry is used
+    # only while the path, mtime, size and inode of its file are the same
+    __slots__ = ('path', 'max_entries', '_E', '_dirty', '_lock')
+
+    def __init__(self, path=None, max_entries=CACHE_MAX_ENTRIES):
+        self.path = os.path.join(cache_dir(), CACHE_NAME) if path is None else path
+        self.max_entries = max_entries
+        self._E = {}
+        self._dirty = False
+        self._lock = Lock()
+        try:
+            with open(self.path) as file:
+                C = json.load(file)
+            if C.get('version') == CACHE_VERSION and isinstance(C.get('entries'), dict):
+                self._E = C['entries']
+        except (OSError, ValueError, AttributeError):
+            # a missing or broken cache is an empty one
+            pass
+
+    # the rules of ignore file f, or None if it does not exist
+    def rules(self, f, st=None):
+        f = os.path.abspath(f)
+        try:
+            st = os.stat(f) if st is None else st
+        except OSError:
+            return None
+        key = [st.st_mtime_ns, st.st_size, st.st_ino]
+        with self._lock:
+            e = self._E.get(f)
+            if e is not None and e.get('stat') == key:
+                if (now := time.time()) - e.get('used', 0) > USED_SECONDS:
+                    e['used'] = now
+                    self._dirty = True
+                return tuple( (r, n) for r, n in e['rules'] )
+        try:
+            with open(f) as file:
+                R = tuple( r for r in map(translate_gitignore, file) if r )
+        except OSError:
+            return None
+        if time.time_ns() - st.st_mtime_ns > RACY_SECONDS * 10**9:
+            with self._lock:
+                self._E[f] = { 'stat': key, 'used': time.time(), 'rules': R }
+                self._dirty = True
+        return R
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            E = self._E
+            if len(E) > self.max_entries:
+                K = sorted(E, key=lambda f: E[f].get('used', 0))
+                for f in K[:len(E) - self.max_entries]:
+                    del E[f]
+            C = { 'version': CACHE_VERSION, 'entries': E }
+            d = os.path.dirname(self.path)
+            os.makedirs(d, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(prefix=CACHE_NAME + '.', dir=d)
+            try:
+                with os.fdopen(fd, 'w') as file:
+                    json.dump(C, file, separators=(',', ':'))
+                # concurrent runs each replace the whole file, and the last
+                # one wins
+                os.replace(tmp, self.path)
+            except BaseException:
+                try:
+                    os.remove(tmp)
+                except FileNotFoundError:
+                    pass
+                raise
+            self._dirty = False
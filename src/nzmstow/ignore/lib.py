@@ -1,120 +1,211 @@
 import os
 import os.path
-import stat
-from .glob import iglob
-from itertools import chain
+import re
+import logging
+from ..stats import count, clock, elapsed
 
-def rparse_gitignore(*, root_dir=os.curdir, gitignore_root_dir=None,
-                     gitignore_name='.gitignore', prepend_ignore=[],
-                     append_ignore=['.git'], include_all_types=False):
+logger = logging.getLogger(__name__)
+
+_SEP = re.escape(os.sep)
+
+def rwalk(root_dir=os.curdir, *, gitignore_root_dirs=None,
+          gitignore_name='.gitignore', onerror=None, onignore=None,
+          top='', scopes=(), cache=None):
     root_dir = os.path.normpath(root_dir)
-    gitignore_root_dir = root_dir if gitignore_root_dir is None else os.path.normpath(gitignore_root_dir)
-
-    def match_(l):
-        return ( os.path.normpath(i)
-                 for i in iglob(l, root_dir=root_dir, recursive=True,
-                                include_hidden=True, follow_symlinks=False) )
-
-    I = set()
-    for gi in walk_gitignore_path(root_dir, gitignore_root_dir, gitignore_name):
-        i = gi.removeprefix(gitignore_root_dir).removeprefix(os.sep)
-        # if any ancestors are ignored
-        if not are_all_ancestors_not_ignored(i, I):
+    gitignore_root_dirs = ( (root_dir,) if gitignore_root_dirs is None else
+                            tuple( os.path.normpath(d) for d in gitignore_root_dirs ) )
+
+    # depth first search, one scandir per directory; ignore files are read
+    # as their directory is entered and apply to the subtree below it.
+    # removing entries from D prunes them, and a subtree can be walked on
+    # its own by passing its path as top and the scopes of its parent.
+    # with cache, rules of unchanged ignore files are not translated again
+    stack = [(top, scopes)]
+    while stack:
+        rd, scopes = stack.pop()
+        try:
+            count('scandir')
+            with os.scandir(root_dir + os.sep + rd if rd else root_dir) as sc:
+                E = list(sc)
+        except OSError as e:
+            if onerror is not None:
+                onerror(e)
+            continue
+
+        t = clock()
+        # the source ignore file is only opened if it is listed
+        has = any( e.name == gitignore_name and e.is_file(follow_symlinks=False) for e in E )
+        scopes = _scope(scopes, rd, ( gd for gd in gitignore_root_dirs
+                                      if gd != root_dir or has ),
+                        gitignore_name, cache)
+        elapsed('ignore-discovery', t)
+
+        t = clock()
+        D = []
+        F = []
+        for e in E:
+            if e.name == gitignore_name:
+                if onignore is not None:
+                    onignore(e)
+                continue
+            r = rd + os.sep + e.name if rd else e.name
+            is_dir = e.is_dir(follow_symlinks=False)
+            if is_ignored(scopes, r, is_dir):
+                logger.debug('scan:ignored:%s', e.path)
+                if onignore is not None:
+                    onignore(e)
+                continue
+            (D if is_dir else F).append(e)
+        elapsed('ignore-match', t)
+
+        yield rd, D, F, scopes
+
+        stack.extend( (rd + os.sep + e.name if rd else e.name, scopes)
+                      for e in reversed(D) )
+
+def rscopes(root_dir=os.curdir, top='', *, gitignore_root_dirs=None,
+            gitignore_name='.gitignore', cache=None):
+    # the scopes rwalk would pass to top, or None if top or a directory
+    # above it is ignored. only the ignore files on the way are read
+    root_dir = os.path.normpath(root_dir)
+    gitignore_root_dirs = ( (root_dir,) if gitignore_root_dirs is None else
+                            tuple( os.path.normpath(d) for d in gitignore_root_dirs ) )
+    scopes = ()
+    rd = ''
+    for k in ( top.split(os.sep) if top else () ):
+        scopes = _scope(scopes, rd, gitignore_root_dirs, gitignore_name, cache)
+        rd = rd + os.sep + k if rd else k
+        if is_ignored(scopes, rd, True):
+            return None
+    return scopes
+
+def enter_scopes(scopes, rd, *, gitignore_root_dirs, gitignore_name='.gitignore',
+                 cache=None):
+    # the scopes of the entries of rd, given the scopes rwalk would pass
+    # to rd, without listing it
+    return _scope(scopes, rd, tuple( os.path.normpath(d) for d in gitignore_root_dirs ),
+                  gitignore_name, cache)
+
+def _scope(scopes, rd, gitignore_root_dirs, gitignore_name, cache):
+    # scopes with the ignore files of rd under each of gitignore_root_dirs
+    R = []
+    for gd in gitignore_root_dirs:
+        f = os.path.join(gd, rd, gitignore_name)
+        if cache is not None:
+            R.extend(cache.rules(f) or ())
             continue
-        base = i.removesuffix(gitignore_name).removesuffix(os.sep)
-        with open(gi) as file:
-            for l in chain(prepend_ignore, file.readlines(), append_ignore):
-                if not (l := l.rstrip('\n')):
-                    continue
-
-                if l.startswith('#'):
-                    continue
-
-                if (l := l.replace('\\\\', '\0')).endswith('\\'):
-                    continue
-
-                l = l.replace(
-                    r'\*', '[*]'
-                ).replace(
-                    r'\[', '[[]'
-                ).replace(
-                    r'\?', '[?]'
-                ).replace(
-                    r'\ ', '\n'
-                ).rstrip(
-                    ' '
-                ).replace(
-                    '\\', ''
-                ).replace(
-                    '\0', '\\'
-                ).replace(
-                    '\n', ' '
-                ).replace(
-                    '/', os.sep
-                )
-
-                rm_from_I = l.startswith('!')
-                l = l[rm_from_I:]
-
-                s = l.split(os.sep)
-                if not {'.', '..'}.isdisjoint(s):
-                    continue
-
-                if l == os.sep:
-                    continue
-
-                if 2 * os.sep in l:
-                    continue
-
-                if os.path.splitdrive(l)[0]:
-                    continue
-
-                l = '**' + os.sep + l if not (-1 < l.find(os.sep) < len(l)-1) else l
-                l = l.removeprefix(os.sep)
-                if s[-1] == '**':
-                    l = l + os.sep + '*'
-                elif s[-1] == '' and '**' == s[-2]:
-                    l = l + '*' + os.sep
-                l = os.path.join(base, l)
-
-                assert not os.path.isabs(l)
-                assert not 2 * os.sep in l
-                m = match_(l)
-                if rm_from_I:
-                    for i in sorted(m):
-                        if are_all_ancestors_not_ignored(i, I):
-                            try:
-                                I.remove(i)
-                            except:
-                                pass
-                else:
-                    I |= set(m)
-
-    D = ( walk_entirely(root_dir, root_dir + os.sep + d)
-          for d in I if stat.S_ISDIR(os.lstat(root_dir + os.sep + d).st_mode) )
-    I = chain(I, chain.from_iterable(D))
-    if not include_all_types:
-        I = ( i for i in I if is_valid_file(root_dir + os.sep + i) )
-    return set( os.path.normpath(i) for i in I )
-
-def walk_entirely(root_dir, d):
-    for p,D,F in os.walk(d):
-        p = p.removeprefix(root_dir).removeprefix(os.sep)
-        for e in chain(D, F):
-            yield p + os.sep + e
-
-def walk_gitignore_path(root_dir, gitignore_root_dir, gitignore_name):
-    for p,D,F in os.walk(root_dir):
         try:
-            i = gitignore_root_dir + p.removeprefix(root_dir) + os.sep + gitignore_name
-            if stat.S_ISREG(os.lstat(i).st_mode):
-                yield i
-        except FileNotFoundError:
+            with open(f) as file:
+                R.extend( r for r in map(translate_gitignore, file) if r )
+        except OSError:
             pass
-
-def is_valid_file(f):
-    m = os.lstat(f).st_mode
-    return stat.S_ISREG(m) or stat.S_ISLNK(m) & (not stat.S_ISDIR(m))
-
-def are_all_ancestors_not_ignored(l, I):
-    return all( { l[:i], l[:i]+os.sep }.isdisjoint(I) for i,j in enumerate(l) if j == os.sep )
+    if R and (g := GitIgnore(tuple(R))):
+        return (*scopes, (len(rd) + bool(rd), g))
+    return scopes
+
+def compile_gitignore(lines):
+    return GitIgnore(tuple( r for r in map(translate_gitignore, lines) if r ))
+
+def translate_gitignore(l):
+    if not (l := l.rstrip('\n')) or l.startswith('#'):
+        return None
+
+    negate = l.startswith('!')
+    l = l[negate:]
+
+    # trailing spaces are ignored unless they are escaped
+    s = l.rstrip(' ')
+    if len(s) < len(l) and _is_escaping(s):
+        s += ' '
+    if _is_escaping(l := s):
+        return None
+
+    dironly = l.endswith('/')
+    l = l.removesuffix('/')
+    if not l or '//' in l or os.path.splitdrive(l)[0]:
+        return None
+
+    anchored = '/' in l
+    P = l.removeprefix('/').split('/')
+    if not {'.', '..'}.isdisjoint(P):
+        return None
+
+    r = '' if anchored else f'(?:.*{_SEP})?'
+    for i, p in enumerate(P, 1):
+        if p != '**':
+            r += _translate_segment(p) + ( _SEP if i < len(P) else '' )
+        elif i < len(P):
+            r += f'(?:.*{_SEP})?'
+        else:
+            r += '.+'
+    r += _SEP if dironly else f'{_SEP}?'
+    return r, negate
+
+def _translate_segment(p):
+    r = ''
+    i, n = 0, len(p)
+    while i < n:
+        c = p[i]
+        i += 1
+        if c == '\\':
+            if i < n:
+                r += re.escape(p[i])
+                i += 1
+        elif c == '*':
+            r += f'[^{_SEP}]*'
+        elif c == '?':
+            r += f'[^{_SEP}]'
+        elif c == '[':
+            j = i + (p[i:i+1] in ('!', '^'))
+            j += p[j:j+1] == ']'
+            while j < n and p[j] != ']':
+                j += 1 + (p[j] == '\\')
+            if j >= n:
+                r += re.escape(c)
+                continue
+            negate = p[i] in ('!', '^')
+            C = p[i+negate:j]
+            i = j + 1
+            k, cls = 0, ''
+            while k < len(C):
+                if C[k] == '\\' and k + 1 < len(C):
+                    k += 1
+                    cls += re.escape(C[k])
+                elif C[k] == '-' and 0 < k < len(C) - 1:
+                    cls += '-'
+                else:
+                    cls += re.escape(C[k])
+                k += 1
+            r += f'[^{cls}{_SEP}]' if negate else f'[{cls}]'
+        else:
+            r += re.escape(c)
+    return r
+
+def _is_escaping(l):
+    return (len(l) - len(l.rstrip('\\'))) % 2 == 1
+
+class GitIgnore:
+    __slots__ = ('_fullmatch', '_negate')
+
+    def __init__(self, rules):
+        # the last matching rule decides, so the alternation is reversed
+        # and the index of the matched group tells which rule it was
+        rules = rules[::-1]
+        self._fullmatch = re.compile('|'.join( f'({r})' for r, _ in rules ) or '(?!)',
+                                     re.DOTALL).fullmatch
+        self._negate = (None, *( n for _, n in rules ))
+
+    def __bool__(self):
+        return len(self._negate) > 1
+
+    # True if ignored, False if re-included by a negated rule and None if
+    # no rule matches
+    def match(self, path, is_dir=False):
+        m = self._fullmatch(path + os.sep if is_dir else path)
+        return None if m is None else not self._negate[m.lastindex]
+
+def is_ignored(scopes, path, is_dir=False):
+    for i, g in reversed(scopes):
+        if (r := g.match(path[i:], is_dir)) is not None:
+            return r
+    return False
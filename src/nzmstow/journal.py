@@ -0,0 +1,165 @@
+import io
+import os
+import json
+import time
+import hashlib
+from threading import Lock
+from itertools import chain, islice
+from .plan import dump_plan, load_plan
+
+JOURNAL_VERSION = 1
+
+# records reach the system as they are written and survive the process
+# being killed; they are synced to disk at most this often. a record lost
+# in a crash only makes its batch run again, which finds it done
+FSYNC_SECONDS = 1
+
+# the plan as dump_plan writes it, then
+#   {"journal": 1, "plan": "sha256 of the lines above", "steps": [[kind, n], ...]}
+# and one line for each batch of operations which completed:
+#   [step, batch]
+# steps are the ones run_steps was given, empty ones included, and batches
+# are numbered within a step in the order run_steps makes them. the file
+# is only appended to, and a torn last line is dropped on reading
+
+class Journal:
+    __slots__ = ('steps', '_file', '_done', '_next', '_synced', '_lock')
+
+    def __init__(self, file, S, done=frozenset()):
+        self.steps = S
+        self._file = file
+        self._done = set(done)
+        self._next = 0
+        self._synced = time.monotonic()
+        self._lock = Lock()
+
+    def step(self):
+        # the next step run_steps runs
+        i = self._next
+        self._next += 1
+        return JournalStep(self, i)
+
+    def done(self, i, b):
+        with self._lock:
+            self._done.add((i, b))
+            if self._file is None:
+                return
+            self._file.write(json.dumps([i, b]) + '\n')
+            if time.monotonic() - self._synced >= FSYNC_SECONDS:
+                self._sync()
+
+    def completed(self):
+        return len(self._done)
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        if self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._synced = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class JournalStep:
+    __slots__ = ('_journal', '_i')
+
+    def __init__(self, journal, i):
+        self._journal = journal
+        self._i = i
+
+    def __contains__(self, b):
+        return (self._i, b) in self._journal._done
+
+    def record(self, f, b):
+        # batch b is done once its future f completes without an error,
+        # in whichever thread completes it
+        f.add_done_callback(lambda f: f.cancelled() or f.exception() is not None
+                                      or self._journal.done(self._i, b))
+
+class _Hashing:
+    # what dump_plan writes, hashed on the way
+    def __init__(self, file):
+        self.file = file
+        self.hash = hashlib.sha256()
+
+    def write(self, s):
+        self.hash.update(s.encode())
+        self.file.write(s)
+
+    def flush(self):
+        self.file.flush()
+
+def create_journal(path, target, S, /):
+    S = tuple(S)
+    file = open(path, 'w', buffering=1)
+    try:
+        h = _Hashing(file)
+        dump_plan(h, target, S)
+        file.write(json.dumps({ 'journal': JOURNAL_VERSION, 'plan': h.hash.hexdigest(),
+                                'steps': [ [kind, len(X)] for kind, X in S ] },
+                              separators=(',', ':')) + '\n')
+        J = Journal(file, S)
+        J.sync()
+    except BaseException:
+        file.close()
+        raise
+    return J
+
+def open_journal(path, /, write=True):
+    # the journal at path with its plan checked against its hash, to be
+    # continued; without write nothing is recorded
+    with open(path, 'rb') as file:
+        h = hashlib.sha256()
+        L = []
+        seal = None
+        end = 0
+        for line in file:
+            if not line.endswith(b'\n'):
+                break
+            end += len(line)
+            if L and line.startswith(b'{'):
+                seal = json.loads(line)
+                break
+            h.update(line)
+            L.append(line.decode())
+        if not isinstance(seal, dict) or seal.get('journal') != JOURNAL_VERSION:
+            raise ValueError(f'{path}: not a complete journal')
+        if seal.get('plan') != h.hexdigest():
+            raise ValueError(f'{path}: the plan does not match its hash')
+        done = set()
+        for line in file:
+            try:
+                if not line.endswith(b'\n'):
+                    break
+                i, b = json.loads(line)
+            except ValueError:
+                break
+            done.add((i, b))
+            end += len(line)
+
+    target, P = load_plan(io.StringIO(''.join(L)))
+    # load_plan joins consecutive steps of one kind, so the operations are
+    # split again as they were run
+    ops = chain.from_iterable( X for _, X in P )
+    S = tuple( (kind, tuple(islice(ops, n))) for kind, n in seal['steps'] )
+    if write:
+        os.truncate(path, end)
+        file = open(path, 'a', buffering=1)
+    else:
+        file = None
+    return target, Journal(file, S, done)
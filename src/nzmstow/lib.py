@@ -1,161 +1,1178 @@
 import os
 import os.path
+import sys
 import stat
+import errno
 import logging
-import concurrent.futures as cf
-from collections import OrderedDict
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from threading import Lock
 from functools import partial
-from itertools import chain, islice, repeat
-from .ignore import rparse_gitignore
+from itertools import chain, groupby, repeat
+from .ignore import rwalk, enter_scopes, is_ignored
+from .executor import open_executor, chunked_by_dir, as_completed, SERIAL_THRESHOLD
+from .stats import count, phase
+from .pathtree import Node, walk_tree, join_rel, plan_view, merged_dirs, PlanOps
 
 logger = logging.getLogger(__name__)
 
+# the manifest, plans, copies and journals are imported where they are
+# used, to keep them out of start-up
+
+# target directories are opened once and operations in them are performed
+# relative to the directory descriptor
+DIR_FD = { os.open, os.stat, os.symlink, os.link, os.unlink, os.mkdir,
+           os.rmdir, os.readlink } <= os.supports_dir_fd
+
+# tasks a streaming stow keeps in flight before the walker waits
+STREAM_DEPTH = 64
+
 def stow(target, /, *sources, dry_run=False,
-         force_remove=False, create_hardlink=False,
-         ignore_name='.nzmstow-local-ignore'):
+         force_remove=False, create_hardlink=False, create_copy=False,
+         ignore_name='.nzmstow-local-ignore', manifest=False, fold=False,
+         jobs=None, executor='auto', stream=False, absolute=False, plan=None,
+         ignore_cache=None, scan=None, journal=None):
+    if not isinstance(target, (str, os.PathLike)):
+        return for_targets(stow, target, *sources, dry_run=dry_run,
+                           force_remove=force_remove, create_hardlink=create_hardlink,
+                           create_copy=create_copy,
+                           ignore_name=ignore_name, manifest=manifest, fold=fold,
+                           jobs=jobs, executor=executor, absolute=absolute, plan=plan,
+                           ignore_cache=ignore_cache, journal=journal)
     dry_run_warning(dry_run)
 
-    TD, ST = compute_target_dirs_and_source_target_pairs(target, *sources,
-                                                         force_remove=force_remove,
-                                                         ignore_name=ignore_name)
+    target = os.path.normpath(target)
+    # folding, the manifest, exporting and the journal need the whole plan
+    if stream and not (fold or manifest or plan or scan or journal):
+        # tasks depend on futures, which cannot be sent to other processes
+        with open_executor('thread' if executor == 'process' else executor, jobs=jobs,
+                           size=0 if dry_run else SERIAL_THRESHOLD) as ex:
+            stream_stow(target, *sources, dry_run=dry_run, force_remove=force_remove,
+                        create_hardlink=create_hardlink, create_copy=create_copy,
+                        ignore_name=ignore_name,
+                        ignore_cache=ignore_cache, absolute=absolute, ex=ex)
+        return
 
-    if force_remove:
-        batch_apply(partial(batch_remove, rm=remove, dry_run=dry_run),
-                    tuple(chain(ST, zip(repeat(None), TD))))
+    P = scan_sources(target, *sources, ignore_name=ignore_name, ignore_cache=ignore_cache,
+                     jobs=jobs, executor=executor, scan=scan)
+    RM = FS = ()
+    UF = {}
+    G = None
+    if fold and not (create_hardlink or create_copy):
+        P, RM, FS, _, UF = fold_plans(target, P)
+    elif fold or manifest:
+        P = folded_view(target, P)
+    else:
+        # the plan is taken from the scan one directory at a time
+        G = merged_dirs(tuple( TS for _, _, TS, _ in P ), target, first_wins=force_remove)
+    if G is None:
+        TD, ST = merge_plans(P, force_remove=force_remove)
+        G = plan_dirs(TD, (*FS, *ST))
+    text = symlink_texts(absolute)
+    base = same_base if create_hardlink or create_copy else symlink_bases(absolute)
+    TD, ST, C = preflight_dirs(G, hardlink=create_hardlink, copy=create_copy,
+                               force_remove=force_remove, base=base, gone=RM)
+    report_conflicts(C)
 
-    for td in TD:
-        mkdir(td, dry_run=dry_run)
+    S = (
+        ('remove', tuple( (None, tf) for _, tf in C ) if force_remove else ()),
+        # unfold directories which are links to other packages
+        ('remove', tuple(zip(repeat(None), RM))),
+        ('mkdir', TD),
+        (link_kind(create_hardlink, create_copy), ST),
+    )
+    if plan is not None:
+        from .plan import dump_plan
+        dump_plan(plan, target, S)
+        return
+
+    with ( open_executor(executor, jobs=jobs, size=0 if dry_run else steps_size(S)) as ex,
+           journaled(journal, target, S, dry_run=dry_run) as J ):
+        run_steps(ex, S, dry_run=dry_run, journal=J)
+
+    if manifest and not dry_run:
+        M = read_manifest(target)
+        record_unfolded(M, target, UF, FS, text=text)
+        for s, TD, TS, _ in P:
+            record_package(M, target, s, TD,
+                           { tf: link_ref(sf, tf, create_hardlink, text=text, copy=create_copy)
+                             for tf, sf in TS.items() },
+                           create_hardlink=create_hardlink, create_copy=create_copy)
+        write_manifest(target, M)
+
+def restow(target, /, *sources, dry_run=False,
+           force_remove=False, create_hardlink=False, create_copy=False,
+           ignore_name='.nzmstow-local-ignore', manifest=False, fold=False,
+           jobs=None, executor='auto', absolute=False, plan=None, ignore_cache=None,
+           scan=None, journal=None):
+    if not isinstance(target, (str, os.PathLike)):
+        return for_targets(restow, target, *sources, dry_run=dry_run,
+                           force_remove=force_remove, create_hardlink=create_hardlink,
+                           create_copy=create_copy,
+                           ignore_name=ignore_name, manifest=manifest, fold=fold,
+                           jobs=jobs, executor=executor, absolute=absolute, plan=plan,
+                           ignore_cache=ignore_cache, journal=journal)
+    dry_run_warning(dry_run)
 
-    batch_apply(partial(batch_link,
-                        ln=(link if create_hardlink else symlink),
-                        dry_run=dry_run), ST)
+    target = os.path.normpath(target)
+    P = scan_sources(target, *sources, ignore_name=ignore_name, ignore_cache=ignore_cache,
+                     jobs=jobs, executor=executor, scan=scan)
+    M = None
+    if manifest:
+        from .manifest import package_key
+        M = read_manifest(target)
+    text = symlink_texts(absolute)
+
+    TD = []
+    RM = []
+    RD = []
+    STs = []
+    C = []
+    UD = FS = ()
+    UF = {}
+    MD = set()
+    if fold and not (create_hardlink or create_copy):
+        P, RM, FS, UD, UF = fold_plans(target, P)
+        RM = list(RM)
+        STs.append(tuple( (text(sf, tf), tf) for sf, tf in FS ))
+    else:
+        P = folded_view(target, P)
+    Rs = [ { tf: link_ref(sf, tf, create_hardlink, text=text, copy=create_copy)
+             for tf, sf in TS.items() } for _, _, TS, _ in P ]
+    # the package whose link stow keeps for each target, and the others
+    # providing it, which leave it alone or give it up
+    W = {}
+    O = {}
+    for i in ( range(len(P)) if force_remove else reversed(range(len(P))) ):
+        for tf in Rs[i]:
+            if W.setdefault(tf, i) != i:
+                O.setdefault(tf, []).append(i)
+    roots = tuple( os.path.abspath(s) + os.sep for s, *_ in P )
+    planned = set(chain.from_iterable( TDs for _, TDs, _, _ in P ))
+    walked = set()
+    emptied = set()
+    for i, (s, TDs, TS, _) in enumerate(P):
+        R = Rs[i]
+        A = dict(TS.items())
+        root = roots[i]
+        old = {}
+        if M is not None and (p := M['packages'].get(package_key(s))):
+            old = { target + os.sep + tf: ref for tf, ref in p['links'] }
+            D = set(TDs)
+            RD.extend( td for td in ( target + os.sep + td for td in p['dirs'] )
+                       if td not in D )
+
+        # compare the plan with what the planned directories hold now
+        for d in chain((target,), TDs):
+            if d in UD:
+                if d not in MD:
+                    MD.add(d)
+                    TD.append(d)
+                continue
+            try:
+                count('scandir')
+                with os.scandir(d) as sc:
+                    E = list(sc)
+            except (FileNotFoundError, NotADirectoryError):
+                TD.append(d)
+                continue
+            for e in E:
+                tf = e.path
+                ref = old.pop(tf, None)
+                if tf in UD:
+                    continue
+                if tf in R:
+                    if W[tf] != i:
+                        # another package wins this target
+                        del A[tf]
+                    elif owns(R[tf], tf):
+                        del A[tf]
+                    elif ( force_remove or e.is_symlink() and points_into(tf, root)
+                           or any( owns(Rs[j][tf], tf) for j in O.get(tf, ()) )
+                           or create_copy and ref is not None and owns(ref, tf) ):
+                        # a stale link, the link of a package which gives the
+                        # target up, or a recorded copy of a changed file
+                        RM.append(tf)
+                    elif not create_copy and samefile(A[tf], tf):
+                        del A[tf]
+                    else:
+                        C.append(( 'conflicting' if e.is_symlink() else 'foreign', tf ))
+                        del A[tf]
+                elif ( e.is_symlink() and points_into(tf, root)
+                       or ref is not None and owns(ref, tf) ):
+                    RM.append(tf)
+                elif ( M is None and tf not in planned and tf not in walked
+                       and e.is_dir(follow_symlinks=False) ):
+                    # without a manifest, directories which left the plan
+                    # are only known by the links into the packages in them.
+                    # others are listed once and not walked into
+                    walked.add(tf)
+                    L, X = scan_links_below(tf, os.path.abspath(tf), roots=roots,
+                                            I=frozenset(), dev=None, shallow=True)
+                    RM.extend(L)
+                    for x in X:
+                        while x != d and x not in emptied:
+                            emptied.add(x)
+                            RD.append(x)
+                            x = os.path.dirname(x)
+
+        # recorded links in directories which are not planned anymore
+        RM.extend( tf for tf, ref in old.items() if owns(ref, tf) )
+
+        # symbolic links are made from their recorded text
+        STs.append(tuple( (sf if create_hardlink or create_copy else R[tf], tf)
+                          for tf, sf in A.items() ))
+
+    ST = tuple(chain.from_iterable( reversed(STs) if not force_remove else STs ))
+    report_conflicts(C)
+    if dry_run:
+        logger.warning('restow:%d to link, %d to remove, %d directories to make',
+                       len(ST), len(RM), len(TD))
+
+    S = (
+        ('remove', tuple(zip(repeat(None), RM))),
+        ('mkdir', TD),
+        (link_kind(create_hardlink, create_copy), ST),
+        ('rmdir', RD),
+    )
+    if plan is not None:
+        from .plan import dump_plan
+        dump_plan(plan, target, S)
+        return
+
+    with ( open_executor(executor, jobs=jobs, size=0 if dry_run else steps_size(S)) as ex,
+           journaled(journal, target, S, dry_run=dry_run) as J ):
+        run_steps(ex, S, dry_run=dry_run, journal=J)
+
+    if manifest and not dry_run:
+        record_unfolded(M, target, UF, FS, text=text)
+        for (s, TDs, _, _), R in zip(P, Rs):
+            record_package(M, target, s, TDs, R, create_hardlink=create_hardlink,
+                           create_copy=create_copy)
+        write_manifest(target, M)
 
 def unstow(target, /, *sources, dry_run=False,
-           force_remove=False,
-           ignore_name='.nzmstow-local-ignore'):
+           force_remove=False, create_hardlink=False, create_copy=False,
+           ignore_name='.nzmstow-local-ignore', manifest=False,
+           jobs=None, executor='auto', scan_target=False, plan=None,
+           ignore_cache=None, scan=None, journal=None):
+    if not isinstance(target, (str, os.PathLike)):
+        return for_targets(unstow, target, *sources, dry_run=dry_run,
+                           force_remove=force_remove, create_hardlink=create_hardlink,
+                           create_copy=create_copy,
+                           ignore_name=ignore_name, manifest=manifest, jobs=jobs,
+                           executor=executor, scan_target=scan_target, plan=plan,
+                           ignore_cache=ignore_cache, journal=journal)
+    dry_run_warning(dry_run)
+
+    target = os.path.normpath(target)
+    R = RT = RD = ()
+    if manifest:
+        from .manifest import package_key
+        M = read_manifest(target)
+        K = M['packages']
+        S = tuple( s for s in sources if package_key(s) not in K )
+        R = tuple( K.pop(k) for k in map(package_key, sources) if k in K )
+        RT = tuple( (ref, target + os.sep + tf) for p in R for tf, ref in p['links'] )
+        RD = tuple( target + os.sep + td for p in R for td in p['dirs'] )
+        sources = S
+
+    TD = ST = RS = ()
+    if sources and scan_target:
+        RS, TD = scan_links(target, *sources, hardlink=create_hardlink,
+                            jobs=jobs, executor=executor)
+    elif sources:
+        # links to folded directories are removed instead of their contents
+        P = folded_view(target, scan_sources(target, *sources, ignore_name=ignore_name,
+                                             ignore_cache=ignore_cache,
+                                             jobs=jobs, executor=executor, scan=scan))
+        TD, ST = merge_plans(P, force_remove=force_remove)
+        RS, ST = preflight_remove(ST, force_remove=force_remove, copy=create_copy)
+
+    S = (
+        ('remove' if force_remove else 'remove-owned', RT),
+        ('rmdir', RD),
+    )
+    S2 = (
+        ('remove', RS),
+        ('remove-same', ST),
+        ('rmdir', TD),
+    )
+    # an exported plan does not change the manifest
+    if plan is not None:
+        from .plan import dump_plan
+        dump_plan(plan, target, (*S, *S2))
+        return
+
+    # a resumed run does not change the manifest
+    with ( open_executor(executor, jobs=jobs,
+                         size=0 if dry_run else steps_size((*S, *S2))) as ex,
+           journaled(journal, target, (*S, *S2), dry_run=dry_run) as J ):
+        run_steps(ex, S, dry_run=dry_run, journal=J)
+        if R and not dry_run:
+            write_manifest(target, M)
+        run_steps(ex, S2, dry_run=dry_run, journal=J)
+
+def apply_plan(file, /, dry_run=False, jobs=None, executor='auto', journal=None):
     dry_run_warning(dry_run)
 
-    TD, ST = compute_target_dirs_and_source_target_pairs(target, *sources,
-                                                         force_remove=force_remove,
-                                                         ignore_name=ignore_name)
+    try:
+        with phase('plan'):
+            from .plan import load_plan
+            target, S = load_plan(file)
+    except (ValueError, KeyError) as e:
+        logger.error('failed:plan:%s', e)
+        raise StowError from e
+    with ( open_executor(executor, jobs=jobs, size=0 if dry_run else steps_size(S)) as ex,
+           journaled(journal, target, S, dry_run=dry_run) as J ):
+        run_steps(ex, S, dry_run=dry_run, journal=J)
+
+def resume(journal, /, dry_run=False, jobs=None, executor='auto'):
+    # continues the run recorded in journal from its plan, without scanning
+    # anything; batches it completed are skipped
+    dry_run_warning(dry_run)
+    from .journal import open_journal
+
+    try:
+        with phase('plan'):
+            target, J = open_journal(journal, write=not dry_run)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.error('failed:journal:%s', e)
+        raise StowError from e
+    logger.info('resume:%s:%d batches done', target, J.completed())
+    with ( J, open_executor(executor, jobs=jobs,
+                            size=0 if dry_run else steps_size(J.steps)) as ex ):
+        run_steps(ex, J.steps, dry_run=dry_run, journal=J)
+
+@contextmanager
+def journaled(path, target, S, /, dry_run):
+    # the journal recording S being run, if there is one
+    if path is None or dry_run:
+        yield None
+        return
+    # imported here, as hashing is only needed with a journal
+    from .journal import create_journal
+    try:
+        J = create_journal(path, target, S)
+    except OSError as e:
+        logger.error('failed:journal:%s', e)
+        raise StowError from e
+    with J:
+        yield J
+
+def status(target, /, *sources):
+    from .manifest import package_key
+    target = os.path.normpath(target)
+    M = read_manifest(target)['packages']
+    for k in ( map(package_key, sources) if sources else tuple(M) ):
+        if (p := M.get(k)) is None:
+            yield k, None, 'unstowed'
+            continue
+        for tf, ref in p['links']:
+            tf = target + os.sep + tf
+            try:
+                os.lstat(tf)
+            except FileNotFoundError:
+                yield k, tf, 'missing'
+                continue
+            yield k, tf, ( 'ok' if owns(ref, tf) else 'changed' )
+
+def stream_stow(target, /, *sources, dry_run, force_remove, create_hardlink,
+                ignore_name, ex, ignore_cache=None, absolute=False, depth=STREAM_DEPTH,
+                create_copy=False):
+    # every walked directory becomes one task which makes its subdirectories
+    # and links its files, after the task which made the directory itself.
+    # only depth tasks are in flight and, with several sources, the overlap
+    # index of paths relative to target
+    ln = copy if create_copy else link if create_hardlink else symlink
+    sources = tuple(OrderedDict.fromkeys( os.path.normpath(s) for s in sources ))
+    # path -> index of the source of its file, or -1 - index for a directory
+    T = {} if len(sources) > 1 else None
+    # (directory, index) -> task which linked the files of that source
+    L = {}
+    W = {}
+    Q = deque()
+    # a directory wins over a file, otherwise the first source to provide a
+    # target wins, as with the full plan
+    for i in ( range(len(sources)) if force_remove else reversed(range(len(sources))) ):
+        s = sources[i]
+        for rd, D, F, _ in rwalk(s, gitignore_root_dirs=(s, target),
+                                 gitignore_name=ignore_name, cache=ignore_cache,
+                                 onerror=partial(logger.warning, 'scan:%s')):
+            d = target + os.sep + rd if rd else target
+            TD = tuple( d + os.sep + e.name for e in D )
+            prefix = None if create_hardlink or create_copy else \
+                symlink_prefix(s + os.sep + rd if rd else s, d, absolute)
+            R = []
+            after = []
+            ST = []
+            if T is not None:
+                k = rd + os.sep if rd else ''
+                for e in D:
+                    if (j := T.setdefault(k + e.name, -1 - i)) >= 0:
+                        # the link of that file is replaced once it is made
+                        sf = os.path.join(sources[j], k + e.name)
+                        logger.warning('overlap:%s', sf)
+                        logger.warning('overlap:%s', e.path)
+                        T[k + e.name] = -1 - i
+                        R.append((link_ref(sf, d + os.sep + e.name, create_hardlink,
+                                           text=partial(symlink_text, absolute=absolute),
+                                           copy=create_copy),
+                                  d + os.sep + e.name))
+                        after.append(L[(rd, j)])
+            for e in F:
+                if dangling(e):
+                    continue
+                if T is not None and (j := T.setdefault(k + e.name, i)) != i:
+                    logger.warning('overlap:%s', os.path.join(sources[max(j, -1 - j)], k + e.name))
+                    logger.warning('overlap:%s', e.path)
+                    continue
+                ST.append((e.path if prefix is None else prefix + e.name, d + os.sep + e.name))
+            f = ex.submit(stream_task, W.pop(d, None), d, TD, tuple(ST), ln=ln,
+                          force_remove=force_remove, dry_run=dry_run,
+                          after=tuple(after), replace=tuple(R))
+            if T is not None:
+                L[(rd, i)] = f
+            W.update( (td, f) for td in TD )
+            Q.append(f)
+            while len(Q) > depth:
+                Q.popleft().result()
+    for f in Q:
+        f.result()
 
-    batch_apply(partial(batch_remove,
-                        rm=( remove if force_remove else safe_remove ),
-                        dry_run=dry_run), ST)
-    for td in reversed(TD):
-        rmdir(td, dry_run=dry_run)
+def stream_task(dep, d, TD, ST, /, ln, force_remove, dry_run, after=(), replace=()):
+    # returns the subdirectories whose contents are to be left alone
+    if dep is not None and d in dep.result():
+        return frozenset(TD)
+    for f in after:
+        f.result()
+    # links of files of another source, made in this run, which a
+    # subdirectory of this one replaces
+    batch_remove(replace, rm=remove_owned, dry_run=dry_run)
+    # a task plans one directory, so a summary of its conflicts is all
+    # that can be given before it starts
+    D = TD
+    TD, ST, C = preflight(TD, ST, hardlink=ln is link, copy=ln is copy,
+                          force_remove=force_remove)
+    report_conflicts(C)
+    if force_remove:
+        with phase('remove'):
+            batch_remove(tuple( (None, tf) for _, tf in C ), rm=remove, dry_run=dry_run)
+    with phase('mkdir'):
+        batch_dir(TD, op=mkdir, dry_run=dry_run)
+    with phase('link'):
+        batch_link(ST, ln=ln, dry_run=dry_run)
+    return frozenset() if force_remove else frozenset(D).intersection( tf for _, tf in C )
 
-def compute_target_dirs_and_source_target_pairs(target, /, *sources,
-                                                force_remove, ignore_name):
+def scan_sources(target, /, *sources, ignore_name, ignore_cache=None,
+                 jobs=None, executor='auto', scan=None):
+    if scan is not None:
+        return scan.plans(target)
     target = os.path.normpath(target)
     sources = tuple(OrderedDict.fromkeys( os.path.normpath(s) for s in sources ))
-    g_i = lambda root_dir, gitignore_root_dir: ( root_dir + os.sep + i
-                                                 for i in rparse_gitignore(
-                                                         gitignore_name=ignore_name,
-                                                         root_dir=root_dir,
-                                                         gitignore_root_dir=gitignore_root_dir,
-                                                         include_all_types=True,
-                                                         append_ignore=[f'/{ignore_name}']) )
-    ignore_set = set(chain(
-        chain.from_iterable(g_i(s, target) for s in sources),
-        chain.from_iterable(g_i(s, s) for s in sources)
-    ))
-
-    TDs, TSs = zip(*( rscan(s, s, target, ignore_set) for s in sources ))
-    T = set()
-    dupT = set()
-    for TS in TSs:
-        for ts in TS:
-            if ts in T:
-                dupT.add(ts)
+    T = scan_tree(target, sources, ignore_name=ignore_name, ignore_cache=ignore_cache,
+                  jobs=jobs, executor=executor)
+    return tuple( (s, *plan_view(T, 1 << i, s, target)) for i, s in enumerate(sources) )
+
+def scan_tree(target, sources, /, ignore_name, ignore_cache, jobs, executor):
+    # without target, ignore files of the target are not read
+    # scanning waits on filesystem metadata, so it runs in threads unless
+    # actions are to be taken serially; with 'auto', once it has taken long
+    # enough for a pool to pay off
+    serial = executor == 'serial' or jobs == 1
+    # all sources share one tree in which source i is bit 1 << i
+    T = Node()
+    with phase('scan'):
+        tops = [ scan_top(s, target, ignore_name=ignore_name, ignore_cache=ignore_cache,
+                          bit=1 << i) for i, s in enumerate(sources) ]
+        # a single subtree gains nothing from a pool but its start-up
+        if sum( len(t[3]) for t in tops ) < 2:
+            serial = True
+        with open_executor(scan_executor(executor, serial), jobs=jobs, size=None) as ex:
+            S = [ submit_scan(*t, ex=ex) for t in tops ]
+            for r in S:
+                T.merge(join_scan(*r))
+    with phase('overlap'):
+        overlap_warnings(T, sources)
+    return T
+
+def scan_executor(executor, serial):
+    # scan tasks return trees, which stay in threads
+    return 'serial' if serial else 'auto' if executor == 'auto' else 'thread'
+
+class SharedScan:
+    # sources scanned once for several targets. the tree does not depend on
+    # the target as long as the target has no ignore files where the scan
+    # went, which is checked per target; what the ignore files of other
+    # targets ignore is taken out of a copy of the tree
+    def __init__(self, *sources, ignore_name, ignore_cache=None, jobs=None,
+                 executor='auto'):
+        self.sources = tuple(OrderedDict.fromkeys( os.path.normpath(s) for s in sources ))
+        self._ignore_name = ignore_name
+        self._ignore_cache = ignore_cache
+        self._jobs = jobs
+        self._executor = executor
+        self._T = None
+        self._lock = Lock()
+
+    def plans(self, target):
+        target = os.path.normpath(target)
+        with self._lock:
+            if self._T is None:
+                self._T = scan_tree(None, self.sources, ignore_name=self._ignore_name,
+                                    ignore_cache=self._ignore_cache, jobs=self._jobs,
+                                    executor=self._executor)
+        T = self._T
+        with phase('target-ignores'):
+            if G := ignore_file_dirs(target, T, self._ignore_name):
+                logger.debug('scan:%s has ignore files', target)
+                T = ignored_by_target(T, target, G, self._ignore_name, self._ignore_cache)
+        return tuple( (s, *plan_view(T, 1 << i, s, target))
+                      for i, s in enumerate(self.sources) )
+
+def ignore_file_dirs(target, T, ignore_name):
+    # directories of T, relative to target, in which target has an ignore
+    # file. directories the target does not have are not looked into
+    G = set()
+    stack = [('', T)]
+    while stack:
+        rd, n = stack.pop()
+        d = join_rel(target, rd)
+        count('stat')
+        if os.path.lexists(d + os.sep + ignore_name):
+            G.add(rd)
+        for k, c in n.dirs.items():
+            count('stat')
+            if os.path.isdir(d + os.sep + k):
+                stack.append((rd + os.sep + k if rd else k, c))
+    return G
+
+def ignored_by_target(T, target, G, ignore_name, ignore_cache=None):
+    # a copy of T without what the ignore files of target in G ignore. as
+    # with a scan, a directory with an ignored entry and the ones above it
+    # are dirty, apart from the top level
+    R = Node()
+    R.mask, R.dirty = T.mask, T.dirty
+    stack = [('', T, R, (), None)]
+    while stack:
+        rd, n, r, scopes, up = stack.pop()
+        if rd in G:
+            scopes = enter_scopes(scopes, rd, gitignore_root_dirs=(target,),
+                                  gitignore_name=ignore_name, cache=ignore_cache)
+        bits = 0
+        for k, m in n.files.items():
+            if is_ignored(scopes, rd + os.sep + k if rd else k):
+                bits |= m
             else:
-                T.add(ts)
-    for t in dupT:
-        for TS in TSs:
+                r.files[k] = m
+        for k, c in n.dirs.items():
+            p = rd + os.sep + k if rd else k
+            if is_ignored(scopes, p, True):
+                bits |= c.mask
+                continue
+            x = r.dirs[k] = Node()
+            x.mask, x.dirty = c.mask, c.dirty
+            stack.append((p, c, x, scopes, (x, up)))
+        u = up
+        while bits and u is not None and u[0].dirty & bits != bits:
+            u[0].dirty |= bits
+            u = u[1]
+    return R
+
+def for_targets(f, targets, /, *sources, ignore_name, ignore_cache, jobs, executor, plan,
+                journal, **kw):
+    # sources are scanned once, and then each target is one task of a
+    # shared pool of threads which plans and runs it serially
+    if plan is not None or journal is not None:
+        raise ValueError('a plan or journal can only be written for one target')
+    targets = tuple(OrderedDict.fromkeys( os.path.normpath(t) for t in targets ))
+    scan = SharedScan(*sources, ignore_name=ignore_name, ignore_cache=ignore_cache,
+                      jobs=jobs, executor=executor)
+    serial = executor == 'serial' or jobs == 1
+    with open_executor('serial' if serial else 'thread', jobs=jobs) as ex:
+        fs = [ ex.submit(f, t, *sources, ignore_name=ignore_name,
+                         ignore_cache=ignore_cache, jobs=1, executor='serial',
+                         scan=scan, **kw) for t in targets ]
+        E = []
+        for t, fu in zip(targets, fs):
             try:
-                logger.warning('overlap:%s', TS[t])
-            except:
-                pass
+                fu.result()
+            except StowError as e:
+                logger.error('failed:%s', t)
+                E.append(e)
+    # the other targets are done before the first failure is raised
+    if E:
+        raise E[0]
+
+def overlap_warnings(T, sources):
+    # files provided by more than one source
+    for rel, n in walk_tree(T):
+        for k, m in n.files.items():
+            if m & (m - 1):
+                for i, s in enumerate(sources):
+                    if m & 1 << i:
+                        logger.warning('overlap:%s', join_rel(s, rel) + os.sep + k)
+
+def scan_links(target, /, *sources, hardlink, jobs=None, executor='auto'):
+    # finds what belongs to sources by looking only at the target: symbolic
+    # links whose text resolves into a source, and with hardlink, files
+    # sharing an inode with a file still in a source. moved or partly
+    # deleted sources are found by their old path. when the manifest has a
+    # record of every source, only target directories which are directories
+    # of what is left of the sources or recorded for them are listed, and
+    # otherwise the whole target is; the sources and directory links,
+    # folded ones included, are not walked into
+    target = os.path.normpath(target)
+    roots = tuple(OrderedDict.fromkeys( os.path.abspath(s) + os.sep for s in sources ))
+    dev = os.stat(target).st_dev
+    serial = executor == 'serial' or jobs == 1
+    with phase('scan'):
+        from .manifest import package_key
+        K = read_manifest(target)['packages']
+        R = [ K.get(package_key(s)) for s in sources ]
+        T, I = source_skeleton(sources, dev, hardlink=hardlink, tree=all(R))
+        if T is not None:
+            for p in R:
+                for rel in chain(p['dirs'], ( os.path.dirname(tf) for tf, _ in p['links'] )):
+                    n = T
+                    for k in ( rel.split(os.sep) if rel else () ):
+                        n = n.dir(k, 1)
+        with open_executor(scan_executor(executor, serial), jobs=jobs, size=None) as ex:
+            RM, D = scan_links_below(target, os.path.abspath(target), roots, I, dev, ex=ex,
+                                     node=T)
+    # directories which held removed entries, and their parents, are
+    # removed if they are left empty
+    TD = set()
+    for d in D:
+        while d != target and d not in TD:
+            TD.add(d)
+            d = os.path.dirname(d)
+    return tuple( (None, tf) for tf in RM ), tuple(sorted(TD))
 
+def scan_links_below(d, a, /, roots, I, dev, ex=None, node=None, shallow=False):
+    # d is listed here and, with ex, each subdirectory is scanned as a
+    # separate task; a is the absolute path of d. with node, only the
+    # subdirectories of its tree are walked into, and with shallow, nothing
+    # below d is unless d itself holds something to remove
+    RM = []
+    D = []
+    fs = []
+    W = [(d, a, node)]
+    while W:
+        d, a, node = W.pop()
+        try:
+            count('scandir')
+            with os.scandir(d) as sc:
+                E = list(sc)
+        except OSError as e:
+            logger.warning('scan:%s', e)
+            continue
+        n = len(RM)
+        for e in E:
+            if e.is_symlink():
+                try:
+                    t = os.path.normpath(os.path.join(a, readlink(e.path))) + os.sep
+                except OSError:
+                    continue
+                if t.startswith(roots):
+                    RM.append(e.path)
+            elif e.is_dir(follow_symlinks=False):
+                sa = a + os.sep + e.name
+                if (sa + os.sep).startswith(roots):
+                    continue
+                if node is None:
+                    c = None
+                elif (c := node.dirs.get(e.name)) is None:
+                    continue
+                if ex is None:
+                    W.append((e.path, sa, c))
+                else:
+                    fs.append(ex.submit(scan_links_below, e.path, sa, roots=roots,
+                                        I=I, dev=dev, node=c))
+            elif e.inode() in I and e.is_file(follow_symlinks=False):
+                count('stat')
+                if e.stat(follow_symlinks=False).st_dev == dev:
+                    RM.append(e.path)
+        if shallow and not RM:
+            break
+        if len(RM) > n:
+            D.append(d)
+    for f in fs:
+        R, S = f.result()
+        RM.extend(R)
+        D.extend(S)
+    return RM, D
+
+def source_skeleton(sources, dev, /, hardlink, tree=True):
+    # the directories of what is left of the sources as one tree, or None
+    # without tree, and with hardlink the inodes of their files on dev, as
+    # hard links can only be matched with those
+    T = Node() if tree else None
+    I = set()
+    if not (tree or hardlink):
+        return T, frozenset(I)
+    for s in sources:
+        W = [(s, T)]
+        while W:
+            d, n = W.pop()
+            try:
+                count('scandir')
+                with os.scandir(d) as sc:
+                    E = list(sc)
+            except OSError:
+                continue
+            for e in E:
+                if e.is_dir(follow_symlinks=False):
+                    W.append((e.path, None if n is None else n.dir(e.name, 1)))
+                elif hardlink and e.is_file(follow_symlinks=False):
+                    try:
+                        count('stat')
+                        st = e.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if st.st_dev == dev:
+                        I.add(st.st_ino)
+    return T, frozenset(I)
+
+def fold_plans(target, P, /):
+    with phase('fold'):
+        return _fold_plans(target, P)
+
+def _fold_plans(target, P, /):
+    # a directory is folded into one link if it does not exist in the
+    # target, only one package provides it and nothing in it is ignored.
+    # links to directories of packages next to the sources are unfolded
+    # when another package needs the directory; UF maps each unfolded
+    # directory to the one it linked to
+    N = Counter( td for _, TD, _, _ in P for td in TD )
+    stow_dirs = tuple(OrderedDict.fromkeys( os.path.dirname(os.path.abspath(s)) + os.sep
+                                            for s, *_ in P ))
+    V = {}
+    U = {}
+    RM = []
+    FS = []
+    UD = set()
+    UF = {}
+    P2 = []
+    for s, TD, TS, X in P:
+        TD2 = []
+        TS2 = {}
+        F = set()
+        for td in TD:
+            if os.path.dirname(td) in F:
+                F.add(td)
+                continue
+            sd = s + td[len(target):]
+            if td in U:
+                od = U.pop(td)
+            else:
+                # nothing is left below a directory which is unfolded
+                # except what is planned here
+                od = ( V[td] if td in V else
+                       None if os.path.dirname(td) in UD else
+                       stowed_dir(td, stow_dirs) )
+                if od != td and od is not None and samepath(od, sd):
+                    od = None if N[td] == 1 and td not in X else sd
+                if od is None and N[td] == 1 and td not in X:
+                    F.add(td)
+                    V[td] = TS2[td] = sd
+                    continue
+                if od != td and od is not None:
+                    RM.append(td)
+            unfold = od != td and od is not None
+            if unfold or os.path.dirname(td) in UD:
+                UD.add(td)
+            if unfold and not samepath(od, sd):
+                UF[td] = od
+                for n in listdir(od):
+                    if (c := td + os.sep + n) in N:
+                        U[c] = od + os.sep + n
+                    else:
+                        FS.append((od + os.sep + n, c))
+                        V[c] = od + os.sep + n
+            V[td] = td
+            TD2.append(td)
+        TS2.update( (tf, sf) for tf, sf in TS.items() if os.path.dirname(tf) not in F )
+        P2.append((s, TD2, TS2, X))
+    return tuple(P2), tuple(RM), tuple(FS), frozenset(UD), UF
+
+def folded_view(target, P, /):
+    # directories which are already links to the source stand for their
+    # whole subtree
+    P2 = []
+    for s, TD, TS, X in P:
+        TD2 = []
+        TS2 = {}
+        F = set()
+        for td in TD:
+            if os.path.dirname(td) in F:
+                F.add(td)
+                continue
+            sd = s + td[len(target):]
+            if (od := stowed_dir(td, ())) != td and od is not None and samepath(od, sd):
+                F.add(td)
+                TS2[td] = sd
+                continue
+            TD2.append(td)
+        TS2.update( (tf, sf) for tf, sf in TS.items() if os.path.dirname(tf) not in F )
+        P2.append((s, TD2, TS2, X))
+    return tuple(P2)
+
+def stowed_dir(td, stow_dirs):
+    # None if td does not exist, the directory td links to if td is a link
+    # to a directory in one of stow_dirs, and td itself otherwise
+    try:
+        if not stat.S_ISLNK(os.lstat(td).st_mode):
+            return td
+        od = os.path.normpath(os.path.join(os.path.dirname(td), os.readlink(td)))
+    except FileNotFoundError:
+        return None
+    except OSError:
+        return td
+    if stow_dirs and not os.path.abspath(od).startswith(stow_dirs):
+        return td
+    return od if os.path.isdir(od) else td
+
+def samepath(a, b):
+    return os.path.abspath(a) == os.path.abspath(b)
+
+def listdir(d):
+    try:
+        return os.listdir(d)
+    except OSError as e:
+        logger.warning('scan:%s', e)
+        return []
+
+def merge_plans(P, /, force_remove):
+    TDs = ( TD for _, TD, _, _ in P )
+    TSs = tuple( TS for _, _, TS, _ in P )
     TD = tuple( td for TD in TDs for td in TD )
     TSs = reversed(TSs) if not force_remove else TSs
     ST = tuple( (s,t) for TS in TSs for t,s in TS.items() )
 
     return TD, ST
 
+def preflight(TD, ST, /, hardlink, force_remove, gone=(), copy=False):
+    # ST is (link text, target) for symbolic links and (source, target)
+    # otherwise, in the order they are made
+    return preflight_dirs(plan_dirs(TD, ST), hardlink=hardlink, force_remove=force_remove,
+                          base=same_base, gone=gone, copy=copy)
+
+def plan_dirs(TD, ST, /):
+    # the directories of a plan given as TD and ST, as preflight_dirs
+    # takes them. an operand ends with the name of its target, and the
+    # first operand of a target is kept
+    E = {}
+    for td in TD:
+        d, k = os.path.split(td)
+        E.setdefault(d, ({}, {}))[0][k] = None
+    for o, tf in ST:
+        d, k = os.path.split(tf)
+        E.setdefault(d, ({}, {}))[1].setdefault(k, o[:len(o)-len(k)])
+    for d in sorted(E, key=lambda d: d.count(os.sep)):
+        D, F = E.pop(d)
+        G = {}
+        for k, p in F.items():
+            G.setdefault(p, []).append(k)
+        yield d, tuple(D.items()), tuple(G.items())
+
+def same_base(p, td):
+    return p
+
+def preflight_dirs(G, /, hardlink, force_remove, base, gone=(), copy=False):
+    with phase('preflight'):
+        return _preflight_dirs(G, hardlink, force_remove, base, gone, copy)
+
+def _preflight_dirs(G, /, hardlink, force_remove, base, gone, copy):
+    # G yields each planned target directory before the ones below it, as
+    # (directory, subdirectories, files): subdirectories are (name, source
+    # directory or None) and files are (p, names), the operand of a name
+    # being base(p, directory) + name. every planned entry is looked up in
+    # one listing of its directory and is missing, correct, conflicting (a
+    # link to something else) or foreign (anything else). only missing
+    # entries are left to make, and conflicting and foreign ones too when
+    # they are removed first. the contents of gone and missing directories
+    # are missing without listing them, and those of kept conflicting
+    # directories and of links to their own source directory, unless
+    # copying, are left alone. a copy whose size and mtime are those of its
+    # source is correct
+    M = set(gone)
+    B = set()
+    TD = []
+    O = []
+    C = []
+    for d, D, F in G:
+        if d in B:
+            B.update( d + os.sep + k for k, _ in D )
+            continue
+        L = {}
+        if d not in M:
+            try:
+                count('scandir')
+                with os.scandir(d) as sc:
+                    L = { e.name: e for e in sc }
+            except OSError as e:
+                logger.debug('preflight:%s', e)
+            if gone:
+                for k in [ k for k in L if d + os.sep + k in M ]:
+                    del L[k]
+        for k, sd in D:
+            f = d + os.sep + k
+            if (e := L.get(k)) is None:
+                M.add(f)
+                TD.append(f)
+                continue
+            if e.is_dir(follow_symlinks=False):
+                continue
+            if ( e.is_symlink() and sd is not None and not copy and
+                 (od := stowed_dir(f, ())) is not None and samepath(od, sd) ):
+                B.add(f)
+                continue
+            C.append(('conflicting' if e.is_symlink() else 'foreign', f))
+            if force_remove:
+                M.add(f)
+                TD.append(f)
+            else:
+                B.add(f)
+        for p, N in F:
+            b = base(p, d)
+            K = []
+            for k in N:
+                if (e := L.get(k)) is None:
+                    K.append(k)
+                    continue
+                f = d + os.sep + k
+                o = b + k
+                if copy:
+                    c = ( 'conflicting' if e.is_symlink() else
+                          None if is_copy(o, f) else 'foreign' )
+                elif not hardlink and e.is_symlink() and readlink(f) == o:
+                    c = None
+                elif samefile(o if hardlink else os.path.join(d, o), f):
+                    c = None
+                else:
+                    c = 'conflicting' if e.is_symlink() else 'foreign'
+                if c is not None:
+                    C.append((c, f))
+                    if force_remove:
+                        K.append(k)
+            if K:
+                O.append((d, p, K))
+    return tuple(TD), PlanOps(O, base), tuple(C)
+
+def preflight_remove(ST, /, force_remove, copy=False):
+    with phase('preflight'):
+        return _preflight_remove(ST, force_remove, copy)
+
+def _preflight_remove(ST, /, force_remove, copy):
+    # entries which do not exist are dropped, and symbolic links whose text
+    # is the one stow would make are removed without comparing files. the
+    # rest is returned to be compared with its source. copies are told by
+    # their size and mtime alone, and are not compared later
+    text = symlink_texts()
+    Ls = {}
+    RS = []
+    CS = []
+    for sf, tf in ST:
+        d = os.path.dirname(tf)
+        if (L := Ls.get(d)) is None:
+            try:
+                count('scandir')
+                with os.scandir(d) as sc:
+                    L = Ls[d] = { e.path: e for e in sc }
+            except OSError:
+                L = Ls[d] = {}
+        if (e := L.get(tf)) is None:
+            continue
+        if copy:
+            if force_remove or not e.is_symlink() and is_copy(sf, tf):
+                RS.append((sf, tf))
+            continue
+        try:
+            owned = force_remove or e.is_symlink() and readlink(tf) == text(sf, tf)
+        except OSError:
+            owned = False
+        ( RS if owned else CS ).append((sf, tf))
+    return tuple(RS), tuple(CS)
+
+def report_conflicts(C):
+    if not C:
+        return
+    N = Counter( k for k, _ in C )
+    logger.warning('conflicts:%s', ', '.join( f'{n} {k}' for k, n in sorted(N.items()) ))
+    for k, tf in C:
+        logger.warning('%s:%s', k, tf)
+
 def dry_run_warning(dry_run):
     if dry_run:
         logger.warning('This is dry-run. None of the commands will be actually performed')
 
-def batch_apply(func, ST):
-    max_workers = os.cpu_count() or 1
-    with cf.ProcessPoolExecutor(max_workers) as ex:
-        fs = ( ex.submit(func, subST)
-               for subST in batched(ST, max_workers + len(ST) // max_workers) )
-        for f in cf.as_completed(fs):
-            f.result()
+def run_steps(ex, S, /, dry_run, journal=None):
+    # with journal, batches it has done are skipped and the others are
+    # recorded as they complete
+    for kind, X in S:
+        J = None if journal is None else journal.step()
+        if kind == 'mkdir':
+            with phase('mkdir'):
+                level_apply(ex, mkdir, X, dry_run=dry_run, journal=J)
+        elif kind == 'rmdir':
+            with phase('rmdir'):
+                level_apply(ex, rmdir, X, dry_run=dry_run, reverse=True, journal=J)
+        elif kind in ('symlink', 'link', 'copy'):
+            ln = { 'symlink': symlink, 'link': link, 'copy': copy }[kind]
+            with phase('copy' if kind == 'copy' else 'link'):
+                batch_apply(ex, partial(batch_link, ln=ln, dry_run=dry_run), X, journal=J)
+        else:
+            rm = { 'remove': remove, 'remove-owned': remove_owned,
+                   'remove-same': safe_remove }[kind]
+            with phase('remove'):
+                batch_apply(ex, partial(batch_remove, rm=rm, dry_run=dry_run), X, journal=J)
+
+def steps_size(S):
+    return sum( len(X) for _, X in S )
+
+def batch_apply(ex, func, ST, journal=None):
+    fs = []
+    for b, subST in enumerate(chunked_by_dir(ST)):
+        if journal is None or b not in journal:
+            fs.append(f := ex.submit(func, subST))
+            if journal is not None:
+                journal.record(f, b)
+    for f in as_completed(fs):
+        f.result()
 
 def batch_link(ST, /, ln, dry_run):
-    for sf, tf in ST:
-        ln(sf, tf, dry_run=dry_run)
+    for td, G in groupby(ST, lambda st: os.path.dirname(st[1])):
+        with opendir(td, dry_run=dry_run) as fd:
+            for sf, tf in G:
+                ln(sf, tf, dry_run=dry_run, dir_fd=fd)
 
 def batch_remove(STFD, /, rm, dry_run):
-    for sfd, tfd in STFD:
-        rm(sfd, tfd, dry_run=dry_run)
+    for td, G in groupby(STFD, lambda st: os.path.dirname(st[1])):
+        with opendir(td, dry_run=dry_run) as fd:
+            for sfd, tfd in G:
+                rm(sfd, tfd, dry_run=dry_run, dir_fd=fd)
+
+def level_apply(ex, op, TD, /, dry_run, reverse=False, journal=None):
+    # directories of one depth are independent of each other, so each
+    # level runs in parallel; parents go first on creation and last on
+    # removal. batches are numbered across levels
+    L = {}
+    for td in OrderedDict.fromkeys(TD):
+        L.setdefault(td.count(os.sep), []).append(td)
+    b = 0
+    for n in sorted(L, reverse=reverse):
+        fs = []
+        for D in chunked_by_dir(L[n], key=os.path.dirname):
+            if journal is None or b not in journal:
+                fs.append(f := ex.submit(batch_dir, D, op=op, dry_run=dry_run))
+                if journal is not None:
+                    journal.record(f, b)
+            b += 1
+        for f in as_completed(fs):
+            f.result()
 
-def batched(iterable, n):
-    # batched('ABCDEFG', 3) --> ABC DEF G
-    if n < 1:
-        raise ValueError('n must be at least one')
-    it = iter(iterable)
-    while batch := tuple(islice(it, n)):
-        yield batch
+def batch_dir(TD, /, op, dry_run):
+    for td, G in groupby(TD, os.path.dirname):
+        with opendir(td, dry_run=dry_run) as fd:
+            for d in G:
+                op(d, dry_run=dry_run, dir_fd=fd)
 
-def rscan(source_root, sd, target_root, ignore_set):
+@contextmanager
+def opendir(td, /, dry_run):
+    fd = None
+    if DIR_FD and not dry_run:
+        try:
+            fd = os.open(td, os.O_RDONLY | os.O_DIRECTORY)
+        except OSError as e:
+            logger.debug('open:%s', e)
     try:
-        sc = os.scandir(sd)
-    except OSError:
-        logger.warning('scan:%s', e)
-        return [], []
-
-    # breadth first search
-    target_dirs = []
-    source_dirs = []
-    target_to_source = {}
-    with sc:
-        for e in sc:
-            if e.path in ignore_set:
-                logger.debug('scan:ignored:%s', e.path)
-                continue
-            try:
-                _ = e.stat()
-            except FileNotFoundError as e:
-                logger.warning('scan:%s', e)
-                continue
-            s = e.path
-            t = target_root + s.removeprefix(source_root)
-            if e.is_dir() & (not e.is_symlink()):
-                source_dirs.append(s)
-                target_dirs.append(t)
-            else:
-                target_to_source[t] = s
+        yield fd
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+def at(f, dir_fd):
+    return f if dir_fd is None else os.path.basename(f)
+
+def scan_top(source_root, target_root, /, ignore_name, ignore_cache=None, bit=1):
+    # the top level is listed here and each of its subtrees is scanned as a
+    # separate task by submit_scan; results are joined in listing order.
+    # ignored entries of the top level do not make anything dirty
+    G = (source_root,) if target_root is None else (source_root, target_root)
+    walk = partial(rwalk, source_root, gitignore_root_dirs=G,
+                   gitignore_name=ignore_name, cache=ignore_cache,
+                   onerror=partial(logger.warning, 'scan:%s'))
+    root = Node()
+    W = walk()
+    if (top := next(W, None)) is None:
+        return root, bit, walk, (), None
+    _, D, F, scopes = top
+    for e in F:
+        if not dangling(e):
+            root.file(e.name, bit)
+    return root, bit, walk, D, scopes
+
+def submit_scan(root, bit, walk, D, scopes, /, ex):
+    fs = tuple( (e.name, ex.submit(scan_subtree, walk, e.name, scopes, bit))
+                for e in D )
+    return root, bit, fs
 
-    for sd in source_dirs:
-        TD, TS = rscan(source_root, sd, target_root, ignore_set)
-        target_dirs.extend(TD)
-        target_to_source.update(TS)
+def scan_subtree(walk, top, scopes, bit):
+    # a directory with an ignored entry and the ones above it up to top
+    # are dirty
+    ignored = False
+    def onignore(e):
+        nonlocal ignored
+        ignored = True
 
-    return target_dirs, target_to_source
+    node = Node()
+    C = { top: (node, None) }
+    for rd, D, F, _ in walk(top=top, scopes=scopes, onignore=onignore):
+        chain = C.pop(rd)
+        n = chain[0]
+        if ignored:
+            ignored = False
+            c = chain
+            while c is not None and not c[0].dirty & bit:
+                c[0].dirty |= bit
+                c = c[1]
+        for e in D:
+            C[rd + os.sep + e.name] = (n.dir(e.name, bit), chain)
+        for e in F:
+            if not dangling(e):
+                n.file(e.name, bit)
+    return node
 
-def mkdir(td, /, dry_run):
+def join_scan(root, bit, fs):
+    for name, f in fs:
+        n = f.result()
+        n.mask |= bit
+        root.dirs[sys.intern(name)] = n
+    return root
+
+def dangling(e):
+    if not e.is_symlink():
+        return False
+    try:
+        count('stat')
+        _ = e.stat()
+    except FileNotFoundError as e:
+        logger.warning('scan:%s', e)
+        return True
+    return False
+
+def mkdir(td, /, dry_run, dir_fd=None):
     try:
         logger.info('mkdir:%s', td)
         if dry_run:
             return
-        os.mkdir(td)
+        count('mkdir')
+        os.mkdir(at(td, dir_fd), dir_fd=dir_fd)
     except FileExistsError as e:
         try:
-            if not stat.S_ISDIR(os.lstat(td).st_mode):
+            count('stat')
+            if not stat.S_ISDIR(os.lstat(at(td, dir_fd), dir_fd=dir_fd).st_mode):
                 logger.warning('mkdir:%s', e)
         except FileNotFoundError:
             return False
@@ -163,73 +1180,220 @@ def mkdir(td, /, dry_run):
         logger.error('failed:mkdir:%s', e)
         raise StowError from e
 
-def link(sf, tf, /, dry_run):
+def link(sf, tf, /, dry_run, dir_fd=None):
     try:
         logger.info('link:%s', tf)
         if dry_run:
             return
-        os.link(sf, tf, follow_symlinks=False)
+        count('link')
+        os.link(sf, at(tf, dir_fd), dst_dir_fd=dir_fd, follow_symlinks=False)
     except FileExistsError as e:
-        if not samefile(sf, tf):
+        if not samefile(sf, tf, dir_fd=dir_fd):
             logger.warning('link:%s', e)
     except OSError as e:
         logger.error('failed:link:%s', e)
         raise StowError from e
 
-def symlink(sf, tf, /, dry_run):
-    if not os.path.isabs(sf):
-        sf = os.path.relpath(os.path.abspath(sf),
-                             os.path.abspath(os.path.dirname(tf)))
+def copy(sf, tf, /, dry_run, dir_fd=None):
+    # sf is the source file
+    try:
+        logger.info('copy:%s', tf)
+        if dry_run:
+            return
+        from .clone import copy_file
+        count('copy')
+        copy_file(sf, at(tf, dir_fd), dir_fd=dir_fd)
+    except FileExistsError as e:
+        if not is_copy(sf, tf, dir_fd=dir_fd):
+            logger.warning('copy:%s', e)
+    except OSError as e:
+        logger.error('failed:copy:%s', e)
+        raise StowError from e
+
+def is_copy(sf, tf, dir_fd=None):
+    try:
+        count('stat', 2)
+        st = os.stat(sf)
+        from .clone import same_copy
+        return same_copy(st.st_size, st.st_mtime_ns, os.lstat(at(tf, dir_fd), dir_fd=dir_fd))
+    except OSError:
+        return False
+
+def link_kind(hardlink, copy):
+    return 'copy' if copy else 'link' if hardlink else 'symlink'
+
+def symlink_text(sf, tf, absolute=False):
+    sd, name = os.path.split(sf)
+    return symlink_prefix(sd, os.path.dirname(tf), absolute) + name
+
+def symlink_texts(absolute=False):
+    # files of one source directory all link into one target directory, so
+    # the path between the two is computed once per pair of directories
+    P = {}
+    def text(sf, tf):
+        sd, name = os.path.split(sf)
+        k = (sd, os.path.dirname(tf))
+        if (prefix := P.get(k)) is None:
+            prefix = P[k] = symlink_prefix(*k, absolute)
+        return prefix + name
+    return text
+
+def symlink_bases(absolute=False):
+    # as symlink_texts, for preflight_dirs, where p is the source directory
+    # of the files with its separator
+    P = {}
+    def base(p, td):
+        if (prefix := P.get(k := (p, td))) is None:
+            prefix = P[k] = symlink_prefix(p[:-1], td, absolute)
+        return prefix
+    return base
+
+def symlink_prefix(sd, td, absolute=False):
+    if os.path.isabs(sd):
+        return sd + os.sep
+    if absolute:
+        return os.path.abspath(sd) + os.sep
+    rd = os.path.relpath(os.path.abspath(sd), os.path.abspath(td))
+    return '' if rd == os.curdir else rd + os.sep
+
+def symlink(sf, tf, /, dry_run, dir_fd=None):
+    # sf is the link text, see symlink_texts
     try:
         logger.info('symlink:%s -> %s', sf, tf)
         if dry_run:
             return
-        os.symlink(sf, tf)
+        count('symlink')
+        os.symlink(sf, at(tf, dir_fd), dir_fd=dir_fd)
     except FileExistsError as e:
         sf = os.path.join(os.path.dirname(tf), sf)
-        if not samefile(sf, tf):
+        if not samefile(sf, tf, dir_fd=dir_fd):
             logger.warning('symlink:%s', e)
     except OSError as e:
         logger.error('failed:symlink:%s', e)
         raise StowError from e
 
-def remove(_, tf, /, dry_run):
+def remove(_, tf, /, dry_run, dir_fd=None):
     try:
         logger.info('remove:%s', tf)
         if dry_run:
             return
-        os.remove(tf)
+        count('unlink')
+        os.remove(at(tf, dir_fd), dir_fd=dir_fd)
     except (IsADirectoryError, FileNotFoundError) as e:
         logger.debug('remove:%s', e)
     except OSError as e:
         logger.error('failed:remove:%s', e)
         raise StowError from e
 
-def safe_remove(sf, tf, /, dry_run):
-    if samefile(sf, tf):
-        remove(sf, tf, dry_run=dry_run)
+def safe_remove(sf, tf, /, dry_run, dir_fd=None):
+    if samefile(sf, tf, dir_fd=dir_fd):
+        remove(sf, tf, dry_run=dry_run, dir_fd=dir_fd)
+
+def remove_owned(ref, tf, /, dry_run, dir_fd=None):
+    if owns(ref, tf, dir_fd=dir_fd):
+        remove(ref, tf, dry_run=dry_run, dir_fd=dir_fd)
+
+def points_into(tf, root):
+    try:
+        return os.path.abspath(os.path.join(os.path.dirname(tf),
+                                            readlink(tf))).startswith(root)
+    except OSError:
+        return False
+
+def link_ref(sf, tf, hardlink, text=symlink_text, copy=False):
+    if copy:
+        count('stat')
+        st = os.stat(sf)
+        return { 'size': st.st_size, 'mtime': st.st_mtime_ns }
+    if not hardlink:
+        return text(sf, tf)
+    count('stat')
+    st = os.lstat(sf)
+    return [st.st_dev, st.st_ino]
+
+def owns(ref, tf, dir_fd=None):
+    try:
+        if isinstance(ref, str):
+            return readlink(at(tf, dir_fd), dir_fd=dir_fd) == ref
+        count('stat')
+        st = os.lstat(at(tf, dir_fd), dir_fd=dir_fd)
+        if isinstance(ref, dict):
+            from .clone import same_copy
+            return same_copy(ref['size'], ref['mtime'], st)
+        return [st.st_dev, st.st_ino] == ref
+    except OSError:
+        return False
 
-def samefile(sf, tf):
+def readlink(f, dir_fd=None):
+    count('readlink')
+    return os.readlink(f, dir_fd=dir_fd)
+
+def samefile(sf, tf, dir_fd=None):
     try:
-        return os.path.samefile(sf, tf)
+        count('stat', 2)
+        return os.path.samestat(os.stat(sf), os.stat(at(tf, dir_fd), dir_fd=dir_fd))
     except FileNotFoundError:
         return False
     
-def rmdir(td, /, dry_run):
+def rmdir(td, /, dry_run, dir_fd=None):
     try:
         logger.info('rmdir:%s', td)
-        with os.scandir(td) as s:
-            for _ in s:
-                logger.debug('rmdir:%s not empty', td)
-                return
         if dry_run:
             return
-        os.rmdir(td)
+        # rmdir itself is the emptiness check
+        count('rmdir')
+        os.rmdir(at(td, dir_fd), dir_fd=dir_fd)
     except (NotADirectoryError, FileNotFoundError) as e:
         logger.debug('rmdir:%s', e)
     except OSError as e:
+        if e.errno in (errno.ENOTEMPTY, errno.EEXIST):
+            logger.debug('rmdir:%s not empty', td)
+            return
         logger.error('failed:rmdir:%s', e)
         raise StowError from e
 
+def record_unfolded(M, target, UF, FS, /, text):
+    # a package whose directory link was unfolded owns the directory and
+    # the links made from its contents instead. packages stowed in this
+    # run are recorded anew, so only the others are rewritten
+    if not UF:
+        return
+    n = len(target) + 1
+    for p in M['packages'].values():
+        F = { target + os.sep + tf for tf, _ in p['links'] } & UF.keys()
+        if not F:
+            continue
+        D = { d for d in UF if any( d == f or d.startswith(f + os.sep) for f in F ) }
+        p['dirs'].extend( d[n:] for d in sorted(D) )
+        p['links'] = [ [tf, ref] for tf, ref in p['links'] if target + os.sep + tf not in F ]
+        p['links'].extend( [tf[n:], text(sf, tf)] for sf, tf in FS
+                           if os.path.dirname(tf) in D )
+
+def record_package(M, target, source, TD, R, /, create_hardlink, create_copy=False):
+    from .manifest import package_key
+    M['packages'][package_key(source)] = {
+        'kind': 'copy' if create_copy else 'hardlink' if create_hardlink else 'symlink',
+        'dirs': [ td[len(target)+1:] for td in TD ],
+        'links': [ [tf[len(target)+1:], ref] for tf, ref in R.items() ],
+    }
+
+def read_manifest(target):
+    from .manifest import load_manifest
+    try:
+        return load_manifest(target)
+    except (OSError, ValueError) as e:
+        logger.error('failed:manifest:%s', e)
+        raise StowError from e
+
+def write_manifest(target, M):
+    try:
+        logger.info('manifest:%s', target)
+        with phase('manifest'):
+            from .manifest import save_manifest
+            save_manifest(target, M)
+    except OSError as e:
+        logger.error('failed:manifest:%s', e)
+        raise StowError from e
+
 class StowError(Exception):
     pass
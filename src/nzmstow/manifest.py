@@ -0,0 +1,49 @@
+import os
+import os.path
+import json
+
+MANIFEST_NAME = '.nzmstow-manifest'
+MANIFEST_VERSION = 1
+
+# {"version": 1,
+#  "packages": {"/abs/source": {"kind": "symlink" | "hardlink" | "copy",
+#                               "dirs": [target relative path, ...],
+#                               "links": [[target relative path, ref], ...]}}}
+#
+# ref is the link text for symlinks, [st_dev, st_ino] for hardlinks and
+# {"size": st_size, "mtime": st_mtime_ns} for copies, so that ownership can
+# be checked without looking at the source.
+
+def manifest_path(target):
+    return os.path.join(target, MANIFEST_NAME)
+
+def package_key(source):
+    return os.path.abspath(source)
+
+def load_manifest(target):
+    try:
+        with open(manifest_path(target)) as file:
+            M = json.load(file)
+    except FileNotFoundError:
+        return {'version': MANIFEST_VERSION, 'packages': {}}
+    if M.get('version') != MANIFEST_VERSION:
+        raise ValueError(f'{manifest_path(target)}: unsupported manifest'
+                         f' version {M.get("version")!r}')
+    return M
+
+def save_manifest(target, M):
+    # tempfile is slow to import and only needed when writing
+    import tempfile
+    fd, tmp = tempfile.mkstemp(prefix=MANIFEST_NAME + '.', dir=target)
+    try:
+        with os.fdopen(fd, 'w') as file:
+            json.dump(M, file, separators=(',', ':'))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, manifest_path(target))
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
@@ -0,0 +1,188 @@
+import os
+import sys
+from collections.abc import Collection, Mapping
+
+# the scan of all sources is kept as one tree of directories relative to
+# the sources and the target. names are interned and which sources provide
+# an entry is a bit mask, so a path shared by several sources or repeated
+# in the source and the target is stored once. full paths are only built
+# by the views handed out as plans
+
+class Node:
+    __slots__ = ('dirs', 'files', 'mask', 'dirty')
+
+    def __init__(self):
+        self.dirs = {}
+        # name -> mask of the sources providing the file
+        self.files = {}
+        # sources providing this directory
+        self.mask = 0
+        # sources with ignored entries somewhere below this directory
+        self.dirty = 0
+
+    def dir(self, name, bit):
+        if (n := self.dirs.get(name)) is None:
+            n = self.dirs[sys.intern(name)] = Node()
+        n.mask |= bit
+        return n
+
+    def file(self, name, bit):
+        self.files[sys.intern(name)] = self.files.get(name, 0) | bit
+
+    def merge(self, other):
+        self.mask |= other.mask
+        self.dirty |= other.dirty
+        for k, m in other.files.items():
+            self.files[k] = self.files.get(k, 0) | m
+        for k, n in other.dirs.items():
+            if (c := self.dirs.get(k)) is None:
+                self.dirs[k] = n
+            else:
+                c.merge(n)
+
+    def find(self, rel):
+        # the directory at rel, or None
+        n = self
+        for k in ( rel.split(os.sep) if rel else () ):
+            if (n := n.dirs.get(k)) is None:
+                return None
+        return n
+
+def walk_tree(node, bit=-1):
+    # directories provided by the sources in bit, each before the ones
+    # below it and in the order they were scanned, with their path
+    # relative to node
+    stack = [('', node)]
+    while stack:
+        rel, n = stack.pop()
+        yield rel, n
+        stack.extend( (rel + os.sep + k if rel else k, c)
+                      for k, c in reversed(n.dirs.items()) if c.mask & bit )
+
+def join_rel(root, rel):
+    return root + os.sep + rel if rel else root
+
+def plan_view(tree, bit, source, target):
+    return ( PlanDirs(tree, bit, target), PlanFiles(tree, bit, source, target),
+             PlanDirs(tree, bit, target, dirty=True) )
+
+class PlanDirs(Collection):
+    # target directories of one source, or with dirty, those with ignored
+    # entries below them
+    __slots__ = ('_tree', '_bit', '_target', '_dirty', '_len')
+
+    def __init__(self, tree, bit, target, dirty=False):
+        self._tree = tree
+        self._bit = bit
+        self._target = target
+        self._dirty = dirty
+        self._len = None
+
+    def __iter__(self):
+        t = self._target
+        for rel, n in walk_tree(self._tree, self._bit):
+            d = join_rel(t, rel)
+            for k, c in n.dirs.items():
+                if ( c.dirty if self._dirty else c.mask ) & self._bit:
+                    yield d + os.sep + k
+
+    def __len__(self):
+        if self._len is None:
+            self._len = sum( 1 for _ in self )
+        return self._len
+
+    def __contains__(self, td):
+        if not isinstance(td, str) or not td.startswith(self._target + os.sep):
+            return False
+        n = self._tree.find(td[len(self._target)+1:])
+        return n is not None and bool(( n.dirty if self._dirty else n.mask ) & self._bit)
+
+class PlanFiles(Mapping):
+    # target file -> source file of one source
+    __slots__ = ('_tree', '_bit', '_source', '_target', '_len')
+
+    def __init__(self, tree, bit, source, target):
+        self._tree = tree
+        self._bit = bit
+        self._source = source
+        self._target = target
+        self._len = None
+
+    def items(self):
+        s, t = self._source, self._target
+        for rel, n in walk_tree(self._tree, self._bit):
+            sd, td = join_rel(s, rel), join_rel(t, rel)
+            for k, m in n.files.items():
+                if m & self._bit:
+                    yield td + os.sep + k, sd + os.sep + k
+
+    def __iter__(self):
+        return ( tf for tf, _ in self.items() )
+
+    def __len__(self):
+        if self._len is None:
+            self._len = sum( 1 for _ in self.items() )
+        return self._len
+
+    def __getitem__(self, tf):
+        if isinstance(tf, str) and tf.startswith(self._target + os.sep):
+            rel = tf[len(self._target)+1:]
+            d, k = os.path.split(rel)
+            if (n := self._tree.find(d)) is not None and n.files.get(k, 0) & self._bit:
+                return self._source + os.sep + rel
+        raise KeyError(tf)
+
+def merged_dirs(TSs, target, first_wins=False):
+    # the target directories of the PlanFiles TSs of one tree, each before
+    # the ones below it, as (directory, subdirectories, files). overlaps
+    # are settled here, by the first or else the last of TSs providing a
+    # file. subdirectories are (name, source directory) pairs with the
+    # source directory when only one source provides them, and files are
+    # (source directory with its separator, names) pairs
+    if not TSs or not all( isinstance(v, PlanFiles) and v._tree is TSs[0]._tree
+                           for v in TSs ):
+        return None
+    S = { v._bit: v._source for v in TSs }
+    bits = 0
+    for b in S:
+        bits |= b
+    return _merged_dirs(TSs[0]._tree, S, bits, target, first_wins)
+
+def _merged_dirs(tree, S, bits, target, first_wins):
+    for rel, n in walk_tree(tree, bits):
+        d = join_rel(target, rel)
+        D = []
+        for k, c in n.dirs.items():
+            if (m := c.mask & bits):
+                D.append((k, join_rel(S[m], rel) + os.sep + k if m in S else None))
+        F = {}
+        for k, m in n.files.items():
+            if (m := m & bits):
+                b = m & -m if first_wins else 1 << (m.bit_length() - 1)
+                F.setdefault(b, []).append(k)
+        yield d, D, [ (join_rel(S[b], rel) + os.sep, N) for b, N in F.items() ]
+
+class PlanOps(Collection):
+    # (operand, target file) pairs kept as (target directory, p, names)
+    # groups, where the operand of a name is base(p, directory) + name. the
+    # pairs are built as they are iterated
+    __slots__ = ('_G', '_base', '_len')
+
+    def __init__(self, G, base):
+        self._G = G
+        self._base = base
+        self._len = None
+
+    def __iter__(self):
+        for d, p, N in self._G:
+            b = self._base(p, d)
+            for k in N:
+                yield b + k, d + os.sep + k
+
+    def __len__(self):
+        if self._len is None:
+            self._len = sum( len(N) for _, _, N in self._G )
+        return self._len
+
+    def __contains__(self, x):
+        return any( x == y for y in self )
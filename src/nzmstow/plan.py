@@ -0,0 +1,60 @@
+import os
+import os.path
+import json
+from itertools import groupby
+
+PLAN_VERSION = 1
+
+# JSON lines; the first line is
+#   {"version": 1, "target": "/abs/target"}
+# and each following one is an operation in the order it is applied:
+#   ["mkdir", td]  ["rmdir", td]  ["remove", tf]
+#   ["symlink", tf, link text]  ["link", tf, "/abs/source"]  ["copy", tf, "/abs/source"]
+#   ["remove-owned", tf, ref]  ["remove-same", tf, "/abs/source"]
+#
+# td and tf are relative to the target and ref is as in the manifest.
+# consecutive operations of one kind form a step, and steps run one after
+# another.
+
+KINDS = ('mkdir', 'rmdir', 'remove', 'symlink', 'link', 'copy', 'remove-owned',
+         'remove-same')
+
+# kinds whose operand is a path outside of the target
+ABSOLUTE = ('link', 'copy', 'remove-same')
+
+def dump_plan(file, target, S, /):
+    # S is a sequence of (kind, operations); directory operations are paths
+    # and the others (operand, path) pairs
+    n = len(target) + 1
+    file.write(json.dumps({'version': PLAN_VERSION, 'target': os.path.abspath(target)},
+                          separators=(',', ':')) + '\n')
+    for kind, X in S:
+        for x in X:
+            if kind in ('mkdir', 'rmdir'):
+                r = [kind, x[n:]]
+            elif kind == 'remove':
+                r = [kind, x[1][n:]]
+            else:
+                a, tf = x
+                r = [kind, tf[n:], os.path.abspath(a) if kind in ABSOLUTE else a]
+            file.write(json.dumps(r, separators=(',', ':')) + '\n')
+    file.flush()
+
+def load_plan(file, /):
+    header = json.loads(file.readline() or 'null')
+    if not isinstance(header, dict) or header.get('version') != PLAN_VERSION:
+        raise ValueError(f'{getattr(file, "name", "plan")}: unsupported plan version'
+                         f' {header and header.get("version")!r}')
+    target = header['target']
+    R = ( json.loads(l) for l in file if l.strip() )
+    S = []
+    for kind, G in groupby(R, lambda r: r[0]):
+        if kind not in KINDS:
+            raise ValueError(f'unknown plan operation {kind!r}')
+        if kind in ('mkdir', 'rmdir'):
+            S.append((kind, tuple( target + os.sep + r[1] for r in G )))
+        elif kind == 'remove':
+            S.append((kind, tuple( (None, target + os.sep + r[1]) for r in G )))
+        else:
+            S.append((kind, tuple( (r[2], target + os.sep + r[1]) for r in G )))
+    return target, S
@@ -0,0 +1,137 @@
+from collections import Counter
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+
+STATS_VERSION = 1
+
+# the Stats being collected, if any. phases which run in several threads
+# at once add up the time of each thread, and calls made in worker
+# processes are not counted
+_current = None
+
+class Stats:
+    __slots__ = ('calls', 'phases', 'executors', 'wall', '_started', '_lock')
+
+    def __init__(self):
+        self.calls = Counter()
+        self.phases = Counter()
+        self.executors = []
+        self.wall = None
+        self._started = perf_counter()
+        self._lock = Lock()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.calls[name] += n
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.phases[name] += seconds
+
+    def finish(self):
+        self.wall = perf_counter() - self._started
+
+    def report(self):
+        return {
+            'version': STATS_VERSION,
+            'wall': self.wall if self.wall is not None else perf_counter() - self._started,
+            'phases': dict(self.phases),
+            'calls': dict(self.calls),
+            'executors': [ e.report() for e in self.executors ],
+        }
+
+class ProfiledExecutor:
+    # times each task where it runs and adds it up as busy time of the
+    # workers; utilisation is busy time over the workers' lifetime. as
+    # profiling is optional, concurrent.futures is imported on first use
+    def __init__(self, ex, kind, workers):
+        self._ex = ex
+        self._kind = kind
+        self._workers = workers
+        self._tasks = 0
+        self._busy = 0.
+        self._started = perf_counter()
+        self._wall = None
+        self._lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        return False
+
+    def submit(self, fn, /, *args, **kwargs):
+        import concurrent.futures as cf
+        f = cf.Future()
+        def done(g):
+            try:
+                t, r = g.result()
+            except BaseException as e:
+                f.set_exception(e)
+                return
+            with self._lock:
+                self._tasks += 1
+                self._busy += t
+            f.set_result(r)
+        self._ex.submit(timed, fn, *args, **kwargs).add_done_callback(done)
+        return f
+
+    def shutdown(self, wait=True, **kwargs):
+        self._ex.shutdown(wait, **kwargs)
+        self._wall = perf_counter() - self._started
+
+    def report(self):
+        wall = self._wall if self._wall is not None else perf_counter() - self._started
+        return {
+            'kind': self._kind,
+            'workers': self._workers,
+            'tasks': self._tasks,
+            'busy': self._busy,
+            'wall': wall,
+            'utilisation': self._busy / (wall * self._workers) if wall else 0.,
+        }
+
+def timed(fn, /, *args, **kwargs):
+    t = perf_counter()
+    r = fn(*args, **kwargs)
+    return perf_counter() - t, r
+
+@contextmanager
+def profile():
+    global _current
+    prev = _current
+    _current = S = Stats()
+    try:
+        yield S
+    finally:
+        S.finish()
+        _current = prev
+
+def profiled(ex, kind, workers):
+    if _current is None:
+        return ex
+    p = ProfiledExecutor(ex, kind, workers)
+    _current.executors.append(p)
+    return p
+
+def count(name, n=1):
+    if _current is not None:
+        _current.count(name, n)
+
+def clock():
+    return perf_counter() if _current is not None else 0.
+
+def elapsed(name, t):
+    # t is 0 if profiling started after clock() was called
+    if _current is not None and t:
+        _current.add_time(name, perf_counter() - t)
+
+@contextmanager
+def phase(name):
+    t = clock()
+    try:
+        yield
+    finally:
+        elapsed(name, t)
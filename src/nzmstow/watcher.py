@@ -0,0 +1,289 @@
+import os
+import os.path
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+from contextlib import closing
+from .ignore import rwalk, rscopes
+from .lib import ( stow, preflight, report_conflicts, run_steps, steps_size,
+                   scan_links_below, symlink_texts, points_into, dangling )
+from .executor import open_executor
+from .pathtree import join_rel
+from .stats import count
+
+logger = logging.getLogger(__name__)
+
+# a batch of events ends when none came for this long, or when it is
+# this old, whichever is first
+DEBOUNCE_SECONDS = 0.2
+BATCH_SECONDS = 2
+
+# how often the polling fallback looks at the watched directories
+POLL_SECONDS = 1
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = ( IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_CLOSE_WRITE |
+               IN_ONLYDIR | IN_DONT_FOLLOW )
+
+# struct inotify_event without its name
+EVENT = struct.Struct('iIII')
+
+def watch(target, /, *sources, dry_run=False, force_remove=False,
+          ignore_name='.nzmstow-local-ignore', jobs=None, executor='auto',
+          absolute=False, ignore_cache=None, poll=False, interval=POLL_SECONDS,
+          debounce=DEBOUNCE_SECONDS):
+    # stows sources and then keeps target in sync with them until
+    # interrupted. a change in a directory of a source compares only that
+    # directory with the target, and a changed ignore file recomputes the
+    # subtree it applies to. ignore files of the target are not watched
+    target = os.path.normpath(target)
+    sources = tuple( os.path.normpath(s) for s in sources )
+    # directories of each source which were ever watched, as only those
+    # can have left links behind in the target
+    K = [ set() for _ in sources ]
+    def walked(i, r):
+        K[i].add(r)
+        W.add(join_rel(sources[i], r), (i, r))
+    with closing(open_watcher(poll, interval, ignore_name)) as W:
+        # watching first, so that changes made while stowing are not missed
+        for i, s in enumerate(sources):
+            for r, *_ in rwalk(s, gitignore_root_dirs=(s, target), gitignore_name=ignore_name,
+                               cache=ignore_cache):
+                walked(i, r)
+        stow(target, *sources, dry_run=dry_run, force_remove=force_remove,
+             ignore_name=ignore_name, jobs=jobs, executor=executor, absolute=absolute,
+             ignore_cache=ignore_cache)
+        logger.info('watch:%s', target)
+        while True:
+            E = W.read()
+            end = time.monotonic() + BATCH_SECONDS
+            while (t := end - time.monotonic()) > 0 and (more := W.read(min(debounce, t))):
+                E.extend(more)
+            B = batch_dirs(E, len(sources), ignore_name)
+            count('watch-batch')
+            logger.debug('watch:%d events in %d directories', len(E), len(B))
+            # parents first, so that their directories exist for the ones below
+            for (i, rd), recursive in sorted(B.items(), key=lambda b: depth(b[0][1])):
+                s = sources[i]
+                sync(target, s, rd, recursive=recursive, ignore_name=ignore_name,
+                     ignore_cache=ignore_cache, absolute=absolute,
+                     force_remove=force_remove, dry_run=dry_run, jobs=jobs,
+                     executor=executor, walked=lambda r, i=i: walked(i, r), known=K[i])
+
+def depth(rd):
+    return rd.count(os.sep) + 1 if rd else 0
+
+def batch_dirs(E, n, ignore_name):
+    # (source, directory) -> whether its whole subtree is recomputed, for
+    # events (key, name, mask) with key (source, directory). files which
+    # were only written keep their links, so only ignore files count then
+    B = {}
+    for key, name, mask in E:
+        if key is None:
+            # events were lost
+            return { (i, ''): True for i in range(n) }
+        if name == ignore_name:
+            B[key] = True
+        elif not mask & IN_CLOSE_WRITE:
+            B.setdefault(key, False)
+    R = [ k for k, r in B.items() if r ]
+    return { k: r for k, r in B.items()
+             if not any( a != k and below(k, a) for a in R ) }
+
+def below(k, a):
+    (i, rd), (j, top) = k, a
+    return i == j and ( not top or rd.startswith(top + os.sep) )
+
+def sync(target, source, rd, /, recursive, ignore_name, ignore_cache, absolute,
+         force_remove, dry_run, jobs=None, executor='auto', walked=None, known=()):
+    # makes target/rd agree with source/rd like restow: links into source
+    # which are not planned anymore are removed, with the directories left
+    # empty, and missing ones are made. without recursive only rd itself
+    # is compared, and subdirectories the target does not have yet are
+    # walked entirely. walked is called with each source directory walked.
+    # a target directory which is not in the source is only searched for
+    # links to remove when its path relative to target is in known, the
+    # source directories walked before
+    sd = join_rel(source, rd)
+    if not os.path.isdir(sd) or os.path.islink(sd):
+        # the parent directory is compared too when rd goes away
+        if not rd:
+            logger.warning('watch:source directory %s is gone', source)
+        return
+    scopes = rscopes(source, rd, gitignore_root_dirs=(source, target),
+                     gitignore_name=ignore_name, cache=ignore_cache)
+    if scopes is None:
+        # so is the parent when rd becomes ignored
+        return
+
+    text = symlink_texts(absolute)
+    K = {}
+    TD = []
+    ST = []
+    for r, D, F, _ in rwalk(source, gitignore_root_dirs=(source, target),
+                            gitignore_name=ignore_name, top=rd, scopes=scopes,
+                            cache=ignore_cache):
+        if walked is not None:
+            walked(r)
+        d = join_rel(target, r)
+        F = [ e for e in F if not dangling(e) ]
+        K[d] = { e.name for e in D } | { e.name for e in F }
+        TD.extend( d + os.sep + e.name for e in D )
+        ST.extend( (text(e.path, d + os.sep + e.name), d + os.sep + e.name) for e in F )
+        if not recursive and r == rd:
+            D[:] = [ e for e in D if not os.path.lexists(d + os.sep + e.name) ]
+
+    root = os.path.abspath(source) + os.sep
+    RM = []
+    RD = set()
+    for d, N in K.items():
+        try:
+            count('scandir')
+            with os.scandir(d) as sc:
+                E = [ e for e in sc if e.name not in N ]
+        except OSError:
+            continue
+        for e in E:
+            if e.is_symlink():
+                if points_into(e.path, root):
+                    RM.append(e.path)
+            elif e.is_dir(follow_symlinks=False) and e.path[len(target)+1:] in known:
+                R, L = scan_links_below(e.path, os.path.abspath(e.path), roots=(root,),
+                                        I=frozenset(), dev=None)
+                RM.extend(R)
+                for x in L:
+                    while x != d and x not in RD:
+                        RD.add(x)
+                        x = os.path.dirname(x)
+
+    TD, ST, C = preflight(TD, ST, hardlink=False, force_remove=force_remove)
+    report_conflicts(C)
+    S = (
+        ('remove', tuple( (None, tf) for tf in RM )),
+        ('rmdir', tuple(sorted(RD))),
+        ('remove', tuple( (None, tf) for _, tf in C ) if force_remove else ()),
+        ('mkdir', TD),
+        ('symlink', ST),
+    )
+    with open_executor(executor, jobs=jobs, size=0 if dry_run else steps_size(S)) as ex:
+        run_steps(ex, S, dry_run=dry_run)
+
+def open_watcher(poll, interval, ignore_name):
+    if not poll:
+        try:
+            return Inotify()
+        except (OSError, AttributeError) as e:
+            logger.info('watch:inotify is not available, polling: %s', e)
+    return Poller(interval, ignore_name)
+
+class Inotify:
+    # inotify watches single directories, so every directory of the
+    # sources is added. events are (key, name, mask) with the key the
+    # directory was added with, and key None when events were lost
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self._fd = fd
+        self._K = {}
+
+    def add(self, path, key):
+        # the same directory added again keeps its descriptor, so a moved
+        # directory is known by its new path once it has been walked
+        wd = self._add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            logger.warning('watch:%s', OSError(e, os.strerror(e), path))
+            return
+        self._K[wd] = key
+
+    def read(self, timeout=None):
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return []
+        try:
+            buf = os.read(self._fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        E = []
+        i = 0
+        while i < len(buf):
+            wd, mask, _, n = EVENT.unpack_from(buf, i)
+            i += EVENT.size
+            name = os.fsdecode(buf[i:i+n].rstrip(b'\0'))
+            i += n
+            if mask & IN_Q_OVERFLOW:
+                E.append((None, '', mask))
+            elif mask & IN_IGNORED:
+                # the directory is gone
+                self._K.pop(wd, None)
+            elif (key := self._K.get(wd)) is not None:
+                E.append((key, name, mask))
+        return E
+
+    def close(self):
+        os.close(self._fd)
+
+class Poller:
+    # stands in for inotify by comparing the mtime of every watched
+    # directory and of the ignore file in it each interval. a directory
+    # changes when entries are added, removed or renamed, which is all a
+    # symbolic link depends on
+    def __init__(self, interval, ignore_name):
+        self._interval = interval
+        self._name = ignore_name
+        self._W = {}
+
+    def _stat(self, path):
+        R = []
+        for f in (path, os.path.join(path, self._name)):
+            try:
+                count('stat')
+                st = os.stat(f)
+                R.append((st.st_mtime_ns, st.st_size, st.st_ino))
+            except OSError:
+                R.append(None)
+        return tuple(R)
+
+    def add(self, path, key):
+        self._W[path] = (key, self._stat(path))
+
+    def read(self, timeout=None):
+        while True:
+            time.sleep(self._interval if timeout is None else min(timeout, self._interval))
+            E = []
+            for path, (key, st) in list(self._W.items()):
+                if (new := self._stat(path)) == st:
+                    continue
+                if new[0] is None:
+                    # the parent directory changed too
+                    del self._W[path]
+                    continue
+                self._W[path] = (key, new)
+                if new[0] != st[0]:
+                    E.append((key, '', 0))
+                if new[1] != st[1]:
+                    E.append((key, self._name, IN_CLOSE_WRITE))
+            if E or timeout is not None:
+                return E
+
+    def close(self):
+        pass
@@ -0,0 +1,31 @@
+import os
+import pytest
+
+@pytest.fixture
+def touch():
+    # creates empty files at paths relative to root, and the directories above them
+    def touch(root, *F):
+        for f in F:
+            os.makedirs(os.path.dirname(os.path.join(root, f)), exist_ok=True)
+            open(os.path.join(root, f), 'w').close()
+    return touch
+
+@pytest.fixture
+def listing(monkeypatch):
+    # the directories os.scandir lists from here on, in order
+    L = []
+    scandir = os.scandir
+    def listing(path='.'):
+        L.append(os.path.normpath(path))
+        return scandir(path)
+    monkeypatch.setattr(os, 'scandir', listing)
+    return L
+
+@pytest.fixture
+def tree():
+    # the entries below t, with the text of those which are links
+    def tree(t):
+        return sorted( (os.path.relpath(os.path.join(d, n), t), os.readlink(os.path.join(d, n))
+                        if os.path.islink(os.path.join(d, n)) else None)
+                       for d, D, F in os.walk(t) for n in D + F )
+    return tree
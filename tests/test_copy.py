@@ -0,0 +1,43 @@
+import os
+import pytest
+from nzmstow import stow, restow, unstow
+from nzmstow.stats import profile
+
+@pytest.fixture
+def package(tmp_path):
+    s, t = tmp_path / 's', tmp_path / 't'
+    (s / 'd').mkdir(parents=True)
+    (s / 'a').write_text('a')
+    (s / 'd' / 'b').write_text('b')
+    t.mkdir()
+    return str(s), str(t)
+
+def test_matching_copy_is_skipped(package):
+    s, t = package
+    stow(t, s, create_copy=True)
+    with profile() as S:
+        stow(t, s, create_copy=True)
+    assert S.calls['copy'] == 0
+    assert open(os.path.join(t, 'd', 'b')).read() == 'b'
+
+def test_unstow_removes_only_matching_copies(package):
+    s, t = package
+    stow(t, s, create_copy=True)
+    with open(os.path.join(t, 'a'), 'a') as file:
+        file.write('changed')
+    unstow(t, s, create_copy=True)
+    assert os.listdir(t) == ['a']
+    assert open(os.path.join(t, 'a')).read() == 'achanged'
+
+def test_restow_replaces_the_copy_of_a_changed_source(package):
+    s, t = package
+    stow(t, s, create_copy=True, manifest=True)
+    with open(os.path.join(s, 'd', 'b'), 'a') as file:
+        file.write('new')
+    st = os.stat(os.path.join(s, 'd', 'b'))
+    os.utime(os.path.join(s, 'd', 'b'), ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    with profile() as S:
+        restow(t, s, create_copy=True, manifest=True)
+    assert S.calls['copy'] == 1
+    assert open(os.path.join(t, 'd', 'b')).read() == 'bnew'
+    assert open(os.path.join(t, 'a')).read() == 'a'
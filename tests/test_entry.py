@@ -0,0 +1,23 @@
+import os
+import sys
+import json
+import subprocess
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+def nzmstow(*args):
+    env = dict(os.environ, PYTHONPATH=SRC)
+    return subprocess.run([sys.executable, '-m', 'nzmstow', *args],
+                          capture_output=True, text=True, check=True, env=env)
+
+def test_profile_leaves_sources_alone(tmp_path):
+    for f in ('a/x', 'b/y'):
+        (tmp_path / f).parent.mkdir(exist_ok=True)
+        (tmp_path / f).touch()
+    (tmp_path / 't').mkdir()
+    t, a, b = ( str(tmp_path / d) for d in 'tab' )
+    assert json.loads(nzmstow('-t', t, '--profile', a, b).stderr)['version'] == 1
+    assert sorted(os.listdir(t)) == ['x', 'y']
+    nzmstow('-t', t, '-D', '--profile', '--profile-output', str(tmp_path / 'p.json'), a, b)
+    assert os.listdir(t) == []
+    assert json.loads((tmp_path / 'p.json').read_text())['version'] == 1
@@ -0,0 +1,36 @@
+import os
+import logging
+import pytest
+from nzmstow import stow, restow, unstow
+
+def tree(t):
+    return sorted( os.path.relpath(os.path.join(d, n), t)
+                   for d, D, F in os.walk(t) for n in D + F
+                   if n != '.nzmstow-manifest' )
+
+@pytest.mark.parametrize('second', [stow, restow])
+def test_unfolded_package_is_unstowed_by_manifest(tmp_path, second, touch):
+    s, t = str(tmp_path / 's'), str(tmp_path / 'tg')
+    touch(s, 'p1/share/top', 'p1/share/x/1', 'p2/share/y/2', 'p2/share/x/z/3')
+    os.mkdir(t)
+    p1, p2 = os.path.join(s, 'p1'), os.path.join(s, 'p2')
+    stow(t, p1, fold=True, manifest=True)
+    assert os.path.islink(os.path.join(t, 'share'))
+    second(t, p2, fold=True, manifest=True)
+    assert not os.path.islink(os.path.join(t, 'share'))
+
+    unstow(t, p1, manifest=True)
+    assert tree(t) == ['share', 'share/x', 'share/x/z', 'share/y']
+    unstow(t, p2, manifest=True)
+    assert tree(t) == []
+
+def test_stow_onto_own_folded_directory(tmp_path, caplog, touch):
+    s, t = str(tmp_path / 's'), str(tmp_path / 'tg')
+    touch(s, 'p1/share/x/1')
+    os.mkdir(t)
+    p1 = os.path.join(s, 'p1')
+    stow(t, p1, fold=True)
+    with caplog.at_level(logging.WARNING):
+        stow(t, p1)
+    assert not [ r for r in caplog.records if 'conflict' in r.getMessage() ]
+    assert os.path.islink(os.path.join(t, 'share'))
@@ -0,0 +1,43 @@
+import os
+import json
+import shutil
+import nzmstow.lib
+from nzmstow import stow
+from nzmstow.lib import resume
+
+def test_resume_runs_only_the_batches_left(tmp_path, monkeypatch, tree):
+    # each directory of files is one batch of links
+    s = tmp_path / 's'
+    for d in range(4):
+        (s / f'd{d}').mkdir(parents=True)
+        for f in range(300):
+            (s / f'd{d}' / f'f{f}').touch()
+    for t in ('t', 'clean'):
+        (tmp_path / t).mkdir()
+    t, journal = str(tmp_path / 't'), str(tmp_path / 'journal')
+    stow(t, str(s), journal=journal, executor='serial')
+    stow(str(tmp_path / 'clean'), str(s), executor='serial')
+
+    # the links of two batches are lost, and so are their records
+    with open(journal) as file:
+        L = file.readlines()
+    n = next( i for i, l in enumerate(L) if l.startswith('{"journal"') ) + 1
+    steps = [ kind for kind, _ in json.loads(L[n - 1])['steps'] ]
+    i = steps.index('symlink')
+    assert sorted( json.loads(l) for l in L[n:] if json.loads(l)[0] == i ) == \
+           [ [i, b] for b in range(4) ]
+    with open(journal, 'w') as file:
+        file.writelines(L[:n] + [ l for l in L[n:] if json.loads(l) not in ([i, 1], [i, 3]) ])
+    for d in ('d1', 'd3'):
+        shutil.rmtree(os.path.join(t, d))
+        os.mkdir(os.path.join(t, d))
+
+    B = []
+    for name in ('batch_link', 'batch_dir'):
+        def counted(*args, f=getattr(nzmstow.lib, name), name=name, **kw):
+            B.append(name)
+            return f(*args, **kw)
+        monkeypatch.setattr(nzmstow.lib, name, counted)
+    resume(journal, executor='serial')
+    assert B == ['batch_link', 'batch_link']
+    assert tree(t) == tree(str(tmp_path / 'clean'))
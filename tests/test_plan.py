@@ -0,0 +1,42 @@
+import io
+import os
+from nzmstow import stow, unstow, apply_plan
+
+def make_targets(root):
+    # two packages sharing a file and a directory, and two targets which
+    # already have a directory and a file of their own
+    for f in ('a/both', 'a/share/x', 'a/bin/t', 'b/both', 'b/share/y', 'b/own/sub/z'):
+        (root / f).parent.mkdir(parents=True, exist_ok=True)
+        (root / f).touch()
+    for t in ('planned', 'direct'):
+        (root / t / 'share').mkdir(parents=True)
+        (root / t / 'share' / 'foreign').touch()
+    return str(root / 'a'), str(root / 'b'), str(root / 'planned'), str(root / 'direct')
+
+def plan(f, target, *sources):
+    file = io.StringIO()
+    f(target, *sources, plan=file)
+    file.seek(0)
+    return file
+
+def test_applied_stow_plan_is_a_stow(tmp_path, tree):
+    a, b, p, d = make_targets(tmp_path)
+    file = plan(stow, p, a, b)
+    # nothing is done until the plan is applied
+    assert tree(p) == tree(d)
+    apply_plan(file)
+    stow(d, a, b)
+    assert tree(p) == tree(d)
+    assert ('both', os.path.join(b, 'both')) in tree(p)
+
+def test_applied_unstow_plan_is_an_unstow(tmp_path, tree):
+    a, b, p, d = make_targets(tmp_path)
+    for t in (p, d):
+        stow(t, a, b)
+    file = plan(unstow, p, a)
+    assert tree(p) == tree(d)
+    apply_plan(file)
+    unstow(d, a)
+    assert tree(p) == tree(d)
+    assert ('share/x', os.path.join(a, 'share', 'x')) not in tree(p)
+    assert ('share/y', os.path.join(b, 'share', 'y')) in tree(p)
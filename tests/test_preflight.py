@@ -0,0 +1,53 @@
+import io
+import os
+import os.path
+import tracemalloc
+import pytest
+from nzmstow.lib import stow
+
+def make_packages(root, dirs=3, files=3):
+    # two packages which share one file and the directory tree
+    for p in ('a', 'b'):
+        for d in range(dirs):
+            (root / p / f'd{d}').mkdir(parents=True)
+            for f in range(files):
+                (root / p / f'd{d}' / f'{p}{f}').touch()
+        (root / p / 'both').touch()
+    (root / 'b' / 'own' / 'sub').mkdir(parents=True)
+    (root / 'b' / 'own' / 'sub' / 'f').touch()
+    (root / 'target').mkdir()
+    return str(root / 'a'), str(root / 'b'), str(root / 'target')
+
+def planned(target, *sources, **kw):
+    file = io.StringIO()
+    stow(target, *sources, plan=file, **kw)
+    return file.getvalue().splitlines()[1:]
+
+@pytest.mark.parametrize('force_remove, winner', [(False, 'b'), (True, 'a')])
+def test_overlap_goes_to_the_winning_source(tmp_path, force_remove, winner):
+    a, b, target = make_packages(tmp_path)
+    stow(target, a, b, force_remove=force_remove)
+    assert os.readlink(os.path.join(target, 'both')) == str(tmp_path / winner / 'both')
+    assert planned(target, a, b, force_remove=force_remove) == []
+
+def test_each_target_directory_listed_once(tmp_path, listing):
+    a, b, target = make_packages(tmp_path)
+    # a directory linked to its own source is left alone with what is below it
+    os.symlink(b + os.sep + 'own', os.path.join(target, 'own'))
+    stow(target, a, b)
+    listing.clear()
+
+    assert planned(target, a, b) == []
+    T = sorted( d for d in listing if d == target or d.startswith(target + os.sep) )
+    assert T == [ target, *( os.path.join(target, f'd{d}') for d in range(3) ) ]
+
+def test_plan_is_kept_per_directory(tmp_path):
+    # the operations of a stow are not held as one path pair each
+    a, b, target = make_packages(tmp_path, dirs=20, files=200)
+    tracemalloc.start()
+    try:
+        stow(target, a, b, dry_run=True, executor='serial')
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < 8000 * 150
@@ -0,0 +1,57 @@
+import os
+import shutil
+import logging
+from nzmstow import stow, restow
+from nzmstow.stats import profile
+
+def test_stale_directory_is_removed(tmp_path, touch):
+    s, t = str(tmp_path / 's'), str(tmp_path / 'tg')
+    touch(s, 'p1/a/b/f', 'p1/a/h')
+    os.mkdir(t)
+    stow(t, os.path.join(s, 'p1'))
+    shutil.rmtree(os.path.join(s, 'p1', 'a', 'b'))
+
+    restow(t, os.path.join(s, 'p1'))
+    assert not os.path.lexists(os.path.join(t, 'a', 'b'))
+    assert os.path.islink(os.path.join(t, 'a', 'h'))
+
+def test_foreign_files_in_stale_directories_are_kept(tmp_path, touch):
+    s, t = str(tmp_path / 's'), str(tmp_path / 'tg')
+    touch(s, 'p1/a/b/f', 'p1/a/h')
+    os.mkdir(t)
+    stow(t, os.path.join(s, 'p1'))
+    touch(t, 'a/b/mine')
+    shutil.rmtree(os.path.join(s, 'p1', 'a', 'b'))
+
+    restow(t, os.path.join(s, 'p1'))
+    assert os.listdir(os.path.join(t, 'a', 'b')) == ['mine']
+
+def test_overlap_moves_to_the_winning_package(tmp_path, caplog, touch):
+    s, t = str(tmp_path / 's'), str(tmp_path / 'tg')
+    touch(s, 'p1/a/g', 'p2/a/g')
+    os.mkdir(t)
+    p1, p2 = os.path.join(s, 'p1'), os.path.join(s, 'p2')
+    g = os.path.join(t, 'a', 'g')
+    stow(t, p1)
+
+    for P, winner in (((p1, p2), p2), ((p1, p2), p2), ((p2, p1), p1)):
+        caplog.clear()
+        with caplog.at_level(logging.WARNING):
+            restow(t, *P)
+        assert os.path.realpath(g) == os.path.realpath(os.path.join(winner, 'a', 'g'))
+        assert not [ r for r in caplog.records if 'conflict' in r.getMessage() ]
+
+def test_unrelated_target_directories_are_listed_once(tmp_path, touch):
+    s, t = str(tmp_path / 's'), str(tmp_path / 'tg')
+    touch(s, 'p1/a/b/f', 'p1/a/h')
+    for i in range(30):
+        os.makedirs(os.path.join(t, f'junk{i}', 'x', 'y', 'z'))
+    p1 = os.path.join(s, 'p1')
+    stow(t, p1)
+
+    with profile() as S:
+        stow(t, p1)
+    with profile() as R:
+        restow(t, p1)
+    # each unrelated directory is looked into, but not walked
+    assert R.calls['scandir'] == S.calls['scandir'] + 30
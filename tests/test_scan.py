@@ -0,0 +1,53 @@
+import os
+import os.path
+import pytest
+from nzmstow.lib import scan_sources, SharedScan
+from nzmstow.stats import profile
+
+IGNORE_NAME = '.nzmstow-local-ignore'
+
+def make_tree(root):
+    # a package with ignore files at two levels, each ignoring a directory
+    # with contents which must not be listed
+    pkg = root / 'pkg'
+    for d in ('a/b/c', 'a/big/x/y', 'node_modules/m/n'):
+        (pkg / d).mkdir(parents=True)
+    (pkg / IGNORE_NAME).write_text('node_modules/\n')
+    (pkg / 'a' / IGNORE_NAME).write_text('*.log\nbig/\n')
+    for f in ('f', 'a/g', 'a/h.log', 'a/big/x/y/z', 'a/b/c/i', 'node_modules/m/n/o'):
+        (pkg / f).touch()
+    (root / 'target').mkdir()
+    return str(pkg), str(root / 'target')
+
+@pytest.mark.parametrize('executor', ['serial', 'thread'])
+def test_one_listing_per_directory(tmp_path, listing, executor):
+    source, target = make_tree(tmp_path)
+
+    with profile() as S:
+        P = scan_sources(target, source, ignore_name=IGNORE_NAME, jobs=2,
+                         executor=executor)
+        planned = sorted( os.path.relpath(sf, source) for _, _, TS, _ in P
+                          for sf in TS.values() )
+
+    walked = [ os.path.join(source, d) for d in ('', 'a', 'a/b', 'a/b/c') ]
+    assert sorted(listing) == sorted( os.path.normpath(d) for d in walked )
+    assert S.calls['scandir'] == len(walked)
+    assert planned == sorted(['f', 'a/g', os.path.join('a', 'b', 'c', 'i')])
+
+def test_shared_scan_applies_the_ignore_files_of_a_target(tmp_path):
+    source, target = make_tree(tmp_path)
+    other = str(tmp_path / 'other')
+    os.makedirs(os.path.join(other, 'a', 'b'))
+    with open(os.path.join(other, IGNORE_NAME), 'w') as file:
+        file.write('f\nc/\n')
+    with open(os.path.join(other, 'a', IGNORE_NAME), 'w') as file:
+        file.write('g\n')
+    scan = SharedScan(source, ignore_name=IGNORE_NAME, executor='serial')
+    with profile() as S:
+        shared = [ scan.plans(t) for t in (target, other) ]
+    assert S.calls['scandir'] == 4
+    for t, P in zip((target, other), shared):
+        (s, TD, TS, X), = scan_sources(t, source, ignore_name=IGNORE_NAME, executor='serial')
+        assert [ (set(TD), dict(TS), set(X)) for _, TD, TS, X in P ] == \
+               [ (set(TD), dict(TS), set(X)) ]
+    assert dict(shared[1][0][2]) == {}
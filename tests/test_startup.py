@@ -0,0 +1,32 @@
+import os
+import sys
+import subprocess
+import threading
+from nzmstow.executor import SpillExecutor, as_completed
+from startup import LAZY
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+def imported(*args):
+    env = dict(os.environ, PYTHONPATH=SRC)
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'nzmstow', *args],
+                       capture_output=True, text=True, check=True, env=env)
+    return { l.split('|')[-1].strip() for l in p.stderr.splitlines()
+             if l.startswith('import time:') }
+
+def test_noop_stow_imports_only_what_it_needs(tmp_path):
+    for d in ('pkg/.config/app', 'pkg/.local/bin', 'target'):
+        (tmp_path / d).mkdir(parents=True)
+    for f in ('.profile', '.config/app/config', '.local/bin/tool'):
+        (tmp_path / 'pkg' / f).touch()
+    args = ('-t', str(tmp_path / 'target'), str(tmp_path / 'pkg'))
+    imported(*args)
+    assert os.path.islink(tmp_path / 'target' / '.profile')
+    assert imported(*args) & set(LAZY) == set()
+
+def test_spill_executor_opens_a_pool_once_over_time():
+    with SpillExecutor(2, seconds=0) as ex:
+        fs = [ ex.submit(threading.get_ident) for _ in range(4) ]
+        assert threading.get_ident() not in { f.result() for f in as_completed(fs) }
+    with SpillExecutor(2) as ex:
+        assert ex.submit(threading.get_ident).result() == threading.get_ident()
@@ -0,0 +1,19 @@
+import pytest
+from nzmstow import stow
+
+@pytest.mark.parametrize('order', [('s1', 's3', 's2'), ('s3', 's2', 's1'), ('s2', 's3', 's1')])
+@pytest.mark.parametrize('force_remove', [False, True])
+def test_directory_wins_over_a_file_of_another_source(tmp_path, tree, order, force_remove):
+    # c.log is a directory in s1 and s2 and a file in s3
+    for s, f in (('s1', 'c.log/x'), ('s2', 'c.log/z'), ('s3', 'c.log'), ('s3', 'd/y')):
+        (tmp_path / s / f).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / s / f).touch()
+    sources = [ str(tmp_path / s) for s in order ]
+    T = []
+    for stream in (False, True, True, True):
+        t = tmp_path / f't{len(T)}'
+        t.mkdir()
+        stow(str(t), *sources, stream=stream, jobs=4, force_remove=force_remove)
+        T.append(tree(str(t)))
+    assert T[1:] == T[:1] * 3
+    assert ('c.log/x', str(tmp_path / 's1' / 'c.log' / 'x')) in T[0]
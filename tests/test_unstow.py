@@ -0,0 +1,62 @@
+import os
+import shutil
+from nzmstow import stow, unstow
+from nzmstow.stats import profile
+
+def entries(t):
+    E = ( os.path.relpath(os.path.join(d, n), t) for d, D, F in os.walk(t) for n in D + F )
+    return sorted( e for e in E if not e.startswith('junk') and e != '.nzmstow-manifest' )
+
+def test_scan_target_lists_only_directories_of_the_package(tmp_path, touch):
+    s, t = str(tmp_path / 's'), str(tmp_path / 'tg')
+    touch(s, 'p1/top', 'p1/a/b/f', 'p1/c/g')
+    for i in range(50):
+        os.makedirs(os.path.join(t, f'junk{i}', 'x'))
+    p1 = os.path.join(s, 'p1')
+    stow(t, p1, manifest=True)
+
+    with profile() as S:
+        unstow(t, p1, scan_target=True, jobs=1)
+    assert entries(t) == []
+    # the source and the target each have four directories
+    assert S.calls['scandir'] == 8
+
+def test_scan_target_removes_folded_links(tmp_path, touch):
+    s, t = str(tmp_path / 's'), str(tmp_path / 'tg')
+    touch(s, 'p1/a/b/f')
+    os.mkdir(t)
+    p1 = os.path.join(s, 'p1')
+    stow(t, p1, fold=True)
+    assert os.path.islink(os.path.join(t, 'a'))
+    unstow(t, p1, scan_target=True)
+    assert entries(t) == []
+
+def test_scan_target_follows_the_manifest_of_a_moved_source(tmp_path, touch):
+    s, t = str(tmp_path / 's'), str(tmp_path / 'tg')
+    touch(s, 'p1/top', 'p1/a/b/f')
+    os.mkdir(t)
+    p1 = os.path.join(s, 'p1')
+    stow(t, p1, manifest=True)
+    shutil.move(p1, p1 + '-moved')
+    unstow(t, p1, scan_target=True)
+    assert entries(t) == []
+
+def test_scan_target_walks_the_target_of_a_moved_source(tmp_path, touch):
+    s, t = str(tmp_path / 's'), str(tmp_path / 'tg')
+    touch(s, 'p1/top', 'p1/a/b/f')
+    os.mkdir(t)
+    p1 = os.path.join(s, 'p1')
+    stow(t, p1)
+    shutil.move(p1, p1 + '-moved')
+    unstow(t, p1, scan_target=True)
+    assert entries(t) == []
+
+def test_scan_target_walks_what_is_gone_from_the_source(tmp_path, touch):
+    s, t = str(tmp_path / 's'), str(tmp_path / 'tg')
+    touch(s, 'p1/top', 'p1/a/b/f', 'p1/c/d/g')
+    os.mkdir(t)
+    p1 = os.path.join(s, 'p1')
+    stow(t, p1)
+    shutil.rmtree(os.path.join(p1, 'c'))
+    unstow(t, p1, scan_target=True)
+    assert entries(t) == []
@@ -0,0 +1,24 @@
+import os
+import shutil
+from nzmstow import stow
+from nzmstow.stats import profile
+from nzmstow.watcher import sync
+
+def test_sync_searches_only_directories_walked_before(tmp_path, touch):
+    s, t = str(tmp_path / 'p1'), str(tmp_path / 'tg')
+    touch(s, 'top', 'a/b/f', 'c/g')
+    for i in range(30):
+        os.makedirs(os.path.join(t, f'junk{i}', 'x', 'y'))
+    stow(t, s)
+    shutil.rmtree(os.path.join(s, 'a'))
+
+    with profile() as S:
+        sync(t, s, '', recursive=False, ignore_name='.nzmstow-local-ignore',
+             ignore_cache=None, absolute=False, force_remove=False, dry_run=False,
+             known={'', 'a', 'a/b', 'c'})
+    assert not os.path.lexists(os.path.join(t, 'a'))
+    assert os.path.islink(os.path.join(t, 'top'))
+    assert all( os.path.isdir(os.path.join(t, f'junk{i}', 'x', 'y')) for i in range(30) )
+    # the source root, the target root for removal and for preflight, and
+    # a and a/b in the target
+    assert S.calls['scandir'] == 5